@@ -6,24 +6,44 @@ import numpy as np
 import plotly.express as px
 import plotly.graph_objects as go
 from streamlit_chat import message
-from PIL import Image
-import torch
-import torch.nn as nn
-import torchvision.transforms as T
 import cv2
+from PIL import Image
 import os
 from fpdf import FPDF
 from werkzeug.security import generate_password_hash, check_password_hash
 import io
-from datetime import datetime
-from torchvision import models 
+from datetime import datetime, timezone, date, timedelta
 import streamlit.components.v1 as components
 import json
+import logging
+import time
+import zipfile
+import csv
+import gzip
+import tempfile
+import hashlib
+import uuid
+import threading
+import atexit
+import queue
+from collections import OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from llm_client import (
+    ChatClient, ChatAPIError, ChatContextWindow, LLMGateway, GatewayBusy, CircuitOpen, DEFAULT_BASE_URL, DEFAULT_MODEL, SUMMARY_INSTRUCTIONS,
+)
+from inference_engine import (
+    CLASSES, PREPROCESS_VERSION, decode_image_file, resize_for_model, to_model_tensor, build_model, predict_proba, generate_gradcam, generate_gradcam_batch,
+    InferenceService, InferenceQueueFull, load_backend,
+)
 
 # -----------------------
 # Config
 # -----------------------
 DB_PATH = "database.db"
+# SQLite pool: max pooled connections per process and busy wait (seconds) before "database is locked"
+DB_POOL_SIZE = int(os.environ.get("OA_DB_POOL_SIZE", "8"))
+DB_BUSY_TIMEOUT = float(os.environ.get("OA_DB_BUSY_TIMEOUT", "15"))
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 PROJECT_ROOT = SCRIPT_DIR
 
@@ -31,8 +51,100 @@ MODEL_PATH = os.path.join(PROJECT_ROOT,
                           "models",
                           "E6_albumentations.pth")
 
-DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
-CLASSES = ["Grade 0", "Grade 1", "Grade 2", "Grade 3", "Grade 4"]
+
+# Batch mode: images per forward pass (ResNet50 on CPU is most efficient around 16-32)
+BATCH_MAX_SIZE = int(os.environ.get("OA_BATCH_MAX_SIZE", "16"))
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png")
+
+# Uploads are copied to a spool file and decoded with these caps; MAX_IMAGE_SIDE bounds the
+# stored/displayed original, MAX_IMAGE_PIXELS rejects decompression bombs before decoding
+MAX_UPLOAD_MB = int(os.environ.get("OA_MAX_UPLOAD_MB", "64"))
+MAX_IMAGE_SIDE = int(os.environ.get("OA_MAX_IMAGE_SIDE", "2048"))
+MAX_IMAGE_PIXELS = int(os.environ.get("OA_MAX_IMAGE_PIXELS", str(150_000_000)))
+UPLOAD_SPOOL_DIR = os.environ.get("OA_UPLOAD_SPOOL_DIR", os.path.join("tmp", "spool"))
+PREVIEW_SIDE = 760
+# Pillow's own bomb check (used when probing headers) follows the same limit
+Image.MAX_IMAGE_PIXELS = MAX_IMAGE_PIXELS
+# Errors an unreadable, truncated, oversized or malicious upload can raise while being decoded
+UPLOAD_ERRORS = (ValueError, OSError, Image.DecompressionBombError)
+
+# Inference log exports: rows fetched per query, where finished files are kept and for how long
+EXPORT_CHUNK_ROWS = int(os.environ.get("OA_EXPORT_CHUNK_ROWS", "5000"))
+EXPORT_DIR = os.environ.get("OA_EXPORT_DIR", os.path.join("tmp", "exports"))
+EXPORT_TTL_HOURS = float(os.environ.get("OA_EXPORT_TTL_HOURS", "24"))
+
+# Bulk patient import: rows validated and inserted per transaction
+IMPORT_BATCH_ROWS = int(os.environ.get("OA_IMPORT_BATCH_ROWS", "5000"))
+
+# Content-addressed store for X-ray originals and Grad-CAM overlays. Unreferenced blobs younger
+# than the grace period are kept by the garbage collector (their prediction may not be saved yet).
+ARTIFACT_DIR = os.environ.get("OA_ARTIFACT_DIR", "artifacts")
+ARTIFACT_GC_GRACE_SECONDS = int(os.environ.get("OA_ARTIFACT_GC_GRACE_SECONDS", str(24 * 3600)))
+# Unreferenced images and stale report copies are also swept on this schedule (0 = only from Settings)
+STORAGE_CLEANUP_INTERVAL_HOURS = float(os.environ.get("OA_STORAGE_CLEANUP_INTERVAL_HOURS", "24"))
+
+# PDF reports: downscaled copies of embedded images are cached here (~135 dpi in a 90 mm column),
+# and bulk exports prepare images on this many threads
+REPORT_IMAGE_DIR = os.environ.get("OA_REPORT_IMAGE_DIR", os.path.join("tmp", "report_images"))
+REPORT_IMAGE_WIDTH = 480
+REPORT_IMAGE_TTL_HOURS = float(os.environ.get("OA_REPORT_IMAGE_TTL_HOURS", "168"))
+REPORT_WORKERS = int(os.environ.get("OA_REPORT_WORKERS", str(min(8, os.cpu_count() or 1))))
+
+# Prediction/heatmap cache: in-memory LRU size and optional on-disk tier (empty = memory only)
+PREDICTION_CACHE_SIZE = int(os.environ.get("OA_PREDICTION_CACHE_SIZE", "128"))
+PREDICTION_CACHE_DIR = os.environ.get("OA_PREDICTION_CACHE_DIR", "")
+
+# Background inference worker processes (0 = run inference inline in the Streamlit script thread)
+INFERENCE_WORKERS = int(os.environ.get("OA_INFERENCE_WORKERS", "0"))
+INFERENCE_MAX_PENDING = int(os.environ.get("OA_INFERENCE_MAX_PENDING", "16"))
+
+# Classification backend: "eager", "torchscript", "onnx" or "int8" (see export_model.py).
+# Grad-CAM always runs on the eager model.
+MODEL_BACKEND = os.environ.get("OA_MODEL_BACKEND", "eager")
+# Memory-map checkpoint weights so all Streamlit and worker processes share one resident copy
+MODEL_SHARED_WEIGHTS = os.environ.get("OA_SHARED_WEIGHTS", "1") == "1"
+
+# Chat Assistant: OpenAI-compatible endpoint (override to point at a local mock), model and HTTP limits
+GROQ_BASE_URL = os.environ.get("OA_GROQ_BASE_URL", DEFAULT_BASE_URL)
+GROQ_MODEL = os.environ.get("OA_GROQ_MODEL", DEFAULT_MODEL)
+GROQ_CONNECT_TIMEOUT = float(os.environ.get("OA_GROQ_CONNECT_TIMEOUT", "5"))
+GROQ_READ_TIMEOUT = float(os.environ.get("OA_GROQ_READ_TIMEOUT", "60"))
+GROQ_RETRIES = int(os.environ.get("OA_GROQ_RETRIES", "3"))
+# Outbound gateway shared by all sessions: concurrent calls, per-key rate (requests/minute and burst),
+# how long a request may queue, and consecutive failures / cooldown seconds for the circuit breaker
+LLM_MAX_IN_FLIGHT = int(os.environ.get("OA_LLM_MAX_IN_FLIGHT", "4"))
+LLM_RATE_PER_MINUTE = float(os.environ.get("OA_LLM_RATE_PER_MINUTE", "30"))
+LLM_BURST = int(os.environ.get("OA_LLM_BURST", "10"))
+LLM_QUEUE_TIMEOUT = float(os.environ.get("OA_LLM_QUEUE_TIMEOUT", "60"))
+LLM_BREAKER_FAILURES = int(os.environ.get("OA_LLM_BREAKER_FAILURES", "5"))
+LLM_BREAKER_COOLDOWN = float(os.environ.get("OA_LLM_BREAKER_COOLDOWN", "30"))
+# Token budget per chat request (prompt + reply); older turns beyond it are summarized
+CHAT_CONTEXT_TOKENS = int(os.environ.get("OA_CHAT_CONTEXT_TOKENS", "6000"))
+CHAT_REPLY_TOKENS = 1024
+CHAT_TEMPERATURE = 0.7
+# Shared reply cache for quick questions and per-grade analyses (TTL in hours, max rows). A server-side
+# GROQ_API_KEY, if set, is only used to pre-warm these answers at startup.
+CHAT_CACHE_TTL_HOURS = float(os.environ.get("OA_CHAT_CACHE_TTL_HOURS", "168"))
+CHAT_CACHE_MAX_ENTRIES = int(os.environ.get("OA_CHAT_CACHE_MAX_ENTRIES", "2000"))
+GROQ_API_KEY = os.environ.get("GROQ_API_KEY", "")
+CHAT_QUICK_QUESTIONS = [
+    "What are the early signs of osteoporosis?",
+    "What foods help improve bone density?",
+    "What exercises are safe for osteoporosis patients?",
+    "How often should I get bone density scans?",
+    "What are the risk factors for osteoporosis?"
+]
+GRADE_SEVERITY = {
+    '0': ('#10b981', 'Normal - Healthy bone density'),
+    '1': ('#3b82f6', 'Mild Osteopenia - Early bone loss'),
+    '2': ('#f59e0b', 'Moderate Osteopenia - Notable bone loss'),
+    '3': ('#f97316', 'Severe Osteopenia - Significant bone loss'),
+    '4': ('#ef4444', 'Osteoporosis - Critical bone density loss')
+}
+CHAT_SYSTEM_PROMPT = """You are an expert medical AI assistant specializing in osteoporosis and bone health. 
+                    Provide accurate, compassionate, and professional medical information. 
+                    Always remind users to consult with healthcare professionals for personalized medical advice.
+                    Be clear, concise, and supportive in your responses."""
 
 # Initialize session state for page navigation
 if "show_landing" not in st.session_state:
@@ -613,169 +725,745 @@ if os.path.exists("assets/style.css"):
 # -----------------------
 # Database helpers & schema (adds inference_logs)
 # -----------------------
-def get_connection():
-    conn = sqlite3.connect(DB_PATH, check_same_thread=False)
-    conn.row_factory = sqlite3.Row
-    return conn
+class ConnectionPool:
+    # Per-process pool of long-lived SQLite connections. Each connection is used by one thread at a
+    # time; keeping them open lets sqlite3 reuse its prepared-statement cache across reruns.
+    def __init__(self, db_path, size=DB_POOL_SIZE):
+        self.db_path = db_path
+        self.size = size
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=DB_BUSY_TIMEOUT, check_same_thread=False, cached_statements=256)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA cache_size=-20000")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        conn.execute(f"PRAGMA busy_timeout={int(DB_BUSY_TIMEOUT * 1000)}")
+        return conn
+
+    def acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if self._created < self.size:
+                self._created += 1
+                try:
+                    return self._connect()
+                except Exception:
+                    self._created -= 1
+                    raise
+        try:
+            return self._idle.get(timeout=DB_BUSY_TIMEOUT)
+        except queue.Empty:
+            raise sqlite3.OperationalError("Timed out waiting for a pooled database connection")
+
+    def release(self, conn):
+        if conn.in_transaction:
+            conn.rollback()
+        self._idle.put(conn)
+
+@st.cache_resource
+def get_db_pool():
+    return ConnectionPool(DB_PATH)
+
+@contextmanager
+def db_connection():
+    pool = get_db_pool()
+    conn = pool.acquire()
+    try:
+        yield conn
+    finally:
+        pool.release(conn)
+
+@contextmanager
+def db_transaction():
+    # Commits on success, rolls back on any exception
+    with db_connection() as conn:
+        with conn:
+            yield conn
 
 def init_db():
-    conn = get_connection()
-    cur = conn.cursor()
-    # users table
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS users (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        username TEXT UNIQUE NOT NULL,
-        password_hash TEXT NOT NULL,
-        full_name TEXT
-    );
-    """)
-    # patients table
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS patients (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        patient_id TEXT UNIQUE,
-        name TEXT,
-        age INTEGER,
-        gender TEXT,
-        last_visit TEXT,
-        notes TEXT,
-        created_by INTEGER,
-        FOREIGN KEY (created_by) REFERENCES users(id)
-    );
-    """)
-    # inference logs table
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS inference_logs (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        patient_id TEXT,
-        predicted_grade TEXT,
-        timestamp TEXT,
-        user_id INTEGER,
-        orig_image_path TEXT,
-        heatmap_path TEXT,
-        notes TEXT,
-        FOREIGN KEY (user_id) REFERENCES users(id)
-    );
-    """)
-    conn.commit()
-    conn.close()
+    with db_transaction() as conn:
+        cur = conn.cursor()
+        # users table
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT UNIQUE NOT NULL,
+            password_hash TEXT NOT NULL,
+            full_name TEXT
+        );
+        """)
+        # patients table
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS patients (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            patient_id TEXT UNIQUE,
+            name TEXT,
+            age INTEGER,
+            gender TEXT,
+            last_visit TEXT,
+            notes TEXT,
+            created_by INTEGER,
+            FOREIGN KEY (created_by) REFERENCES users(id)
+        );
+        """)
+        # inference logs table
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS inference_logs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            patient_id TEXT,
+            predicted_grade TEXT,
+            timestamp TEXT,
+            user_id INTEGER,
+            orig_image_path TEXT,
+            heatmap_path TEXT,
+            notes TEXT,
+            FOREIGN KEY (user_id) REFERENCES users(id)
+        );
+        """)
+
+    migrate_db()
+
+# -----------------------
+# Schema migrations (tracked in PRAGMA user_version)
+# -----------------------
+# Each entry: (version, description, statements). Append only — never edit an applied migration.
+MIGRATIONS = [
+    (1, "numeric grade and epoch timestamp columns on inference_logs", [
+        "ALTER TABLE inference_logs ADD COLUMN grade_level INTEGER",
+        "ALTER TABLE inference_logs ADD COLUMN ts_epoch REAL",
+        """UPDATE inference_logs
+           SET grade_level = CASE WHEN predicted_grade LIKE 'Grade %'
+                                  THEN CAST(substr(predicted_grade, 7) AS INTEGER) END,
+               ts_epoch = (julianday(timestamp) - 2440587.5) * 86400.0""",
+    ]),
+    (2, "indexes for patient, user and time-ordered log scans", [
+        "CREATE INDEX IF NOT EXISTS idx_inference_logs_patient_ts ON inference_logs (patient_id, ts_epoch)",
+        "CREATE INDEX IF NOT EXISTS idx_inference_logs_user ON inference_logs (user_id)",
+        "CREATE INDEX IF NOT EXISTS idx_inference_logs_ts ON inference_logs (ts_epoch)",
+        "CREATE INDEX IF NOT EXISTS idx_patients_created_by ON patients (created_by)",
+    ]),
+    (3, "incrementally maintained summary tables for dashboards", [
+        # stats_totals rows: 'patients', 'inferences' and 'grade:<predicted_grade>'
+        "CREATE TABLE IF NOT EXISTS stats_totals (name TEXT PRIMARY KEY, value INTEGER NOT NULL DEFAULT 0)",
+        """CREATE TABLE IF NOT EXISTS stats_daily_grade (
+               day TEXT NOT NULL, predicted_grade TEXT NOT NULL, count INTEGER NOT NULL DEFAULT 0,
+               PRIMARY KEY (day, predicted_grade))""",
+        "CREATE TABLE IF NOT EXISTS stats_user_counts (user_id INTEGER PRIMARY KEY, count INTEGER NOT NULL DEFAULT 0)",
+        """CREATE TABLE IF NOT EXISTS patient_latest_result (
+               patient_id TEXT PRIMARY KEY, log_id INTEGER, predicted_grade TEXT, ts_epoch REAL,
+               xray_count INTEGER NOT NULL DEFAULT 0)""",
+        """INSERT OR REPLACE INTO stats_totals (name, value)
+           SELECT 'patients', COUNT(*) FROM patients
+           UNION ALL SELECT 'inferences', COUNT(*) FROM inference_logs
+           UNION ALL SELECT 'grade:' || COALESCE(predicted_grade, 'Unknown'), COUNT(*)
+                     FROM inference_logs GROUP BY COALESCE(predicted_grade, 'Unknown')""",
+        """INSERT OR REPLACE INTO stats_daily_grade (day, predicted_grade, count)
+           SELECT COALESCE(substr(timestamp, 1, 10), 'Unknown'), COALESCE(predicted_grade, 'Unknown'), COUNT(*)
+           FROM inference_logs GROUP BY 1, 2""",
+        """INSERT OR REPLACE INTO stats_user_counts (user_id, count)
+           SELECT user_id, COUNT(*) FROM inference_logs WHERE user_id IS NOT NULL GROUP BY user_id""",
+        """INSERT OR REPLACE INTO patient_latest_result (patient_id, log_id, predicted_grade, ts_epoch, xray_count)
+           SELECT il.patient_id, il.id, il.predicted_grade, il.ts_epoch, c.n
+           FROM inference_logs il
+           JOIN (SELECT MAX(id) AS max_id, COUNT(*) AS n FROM inference_logs
+                 WHERE patient_id IS NOT NULL GROUP BY patient_id) c ON il.id = c.max_id""",
+    ]),
+    (4, "indexes for artifact reference counting", [
+        "CREATE INDEX IF NOT EXISTS idx_inference_logs_orig_image ON inference_logs (orig_image_path)",
+        "CREATE INDEX IF NOT EXISTS idx_inference_logs_heatmap ON inference_logs (heatmap_path)",
+    ]),
+    (5, "shared cache of chat assistant replies", [
+        """CREATE TABLE IF NOT EXISTS llm_response_cache (
+               cache_key TEXT PRIMARY KEY, model TEXT NOT NULL, temperature REAL NOT NULL, prompt TEXT NOT NULL,
+               response TEXT NOT NULL, created_at REAL NOT NULL, last_used_at REAL NOT NULL,
+               hits INTEGER NOT NULL DEFAULT 0)""",
+        "CREATE INDEX IF NOT EXISTS idx_llm_response_cache_last_used ON llm_response_cache (last_used_at)",
+    ]),
+    (6, "indexes for keyset-paginated, filtered log browsing", [
+        # Single-column indexes keep rows ordered by id within each key, matching ORDER BY il.id
+        "CREATE INDEX IF NOT EXISTS idx_inference_logs_patient ON inference_logs (patient_id)",
+        "CREATE INDEX IF NOT EXISTS idx_inference_logs_grade ON inference_logs (grade_level)",
+    ]),
+    (7, "regenerated Grad-CAM overlays kept beside the logged heatmap", [
+        # heatmap_path stays what the clinician saw at inference time; re-explanations go here
+        "ALTER TABLE inference_logs ADD COLUMN regenerated_heatmap_path TEXT",
+        "CREATE INDEX IF NOT EXISTS idx_inference_logs_regenerated_heatmap ON inference_logs (regenerated_heatmap_path)",
+    ]),
+]
 
-# initialize DB on startup (creates tables if absent)
+def grade_level(predicted_grade):
+    return CLASSES.index(predicted_grade) if predicted_grade in CLASSES else None
+
+def epoch_from_iso(timestamp):
+    return datetime.fromisoformat(timestamp).replace(tzinfo=timezone.utc).timestamp() if timestamp else None
+
+def migrate_db():
+    with db_connection() as conn:
+        current = conn.execute("PRAGMA user_version").fetchone()[0]
+        for version, description, statements in MIGRATIONS:
+            if version <= current:
+                continue
+            # BEGIN IMMEDIATE takes the write lock so concurrent processes cannot apply a migration twice
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                if conn.execute("PRAGMA user_version").fetchone()[0] >= version:
+                    conn.rollback()
+                    continue
+                for sql in statements:
+                    conn.execute(sql)
+                conn.execute(f"PRAGMA user_version = {int(version)}")
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            current = version
+
+# initialize DB on startup (creates tables if absent, then applies pending migrations)
 init_db()
 
+# -----------------------
+# Summary table maintenance (called inside the writing transaction)
+# -----------------------
+def _bump_total(conn, name, delta=1):
+    conn.execute("""
+        INSERT INTO stats_totals (name, value) VALUES (?, ?)
+        ON CONFLICT(name) DO UPDATE SET value = value + excluded.value
+    """, (name, delta))
+
+def _record_inference_stats(conn, log_id, patient_id, predicted_grade, user_id, timestamp, ts_epoch):
+    grade_key = predicted_grade or "Unknown"
+    _bump_total(conn, "inferences")
+    _bump_total(conn, f"grade:{grade_key}")
+    conn.execute("""
+        INSERT INTO stats_daily_grade (day, predicted_grade, count) VALUES (?, ?, 1)
+        ON CONFLICT(day, predicted_grade) DO UPDATE SET count = count + 1
+    """, (timestamp[:10], grade_key))
+    if user_id is not None:
+        conn.execute("""
+            INSERT INTO stats_user_counts (user_id, count) VALUES (?, 1)
+            ON CONFLICT(user_id) DO UPDATE SET count = count + 1
+        """, (user_id,))
+    if patient_id is not None:
+        conn.execute("""
+            INSERT INTO patient_latest_result (patient_id, log_id, predicted_grade, ts_epoch, xray_count)
+            VALUES (?, ?, ?, ?, 1)
+            ON CONFLICT(patient_id) DO UPDATE SET
+                log_id = excluded.log_id, predicted_grade = excluded.predicted_grade,
+                ts_epoch = excluded.ts_epoch, xray_count = xray_count + 1
+        """, (patient_id, log_id, predicted_grade, ts_epoch))
+
 # -----------------------
 # Authentication helpers
 # -----------------------
 def register_user(username, password, full_name=""):
-    conn = get_connection()
-    cur = conn.cursor()
     try:
         pw_hash = generate_password_hash(password)
-        cur.execute("INSERT INTO users (username, password_hash, full_name) VALUES (?, ?, ?)", (username, pw_hash, full_name))
-        conn.commit()
+        with db_transaction() as conn:
+            conn.execute("INSERT INTO users (username, password_hash, full_name) VALUES (?, ?, ?)", (username, pw_hash, full_name))
         return True, None
     except sqlite3.IntegrityError as e:
         return False, "Username already exists"
-    finally:
-        conn.close()
 
 def authenticate_user(username, password):
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT * FROM users WHERE username = ?", (username,))
-    row = cur.fetchone()
-    conn.close()
+    with db_connection() as conn:
+        row = conn.execute("SELECT * FROM users WHERE username = ?", (username,)).fetchone()
     if row:
         if check_password_hash(row["password_hash"], password):
             return {"id": row["id"], "username": row["username"], "full_name": row["full_name"]}
     return None
 
 def get_user_by_username(username):
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT * FROM users WHERE username = ?", (username,))
-    row = cur.fetchone()
-    conn.close()
-    return row
+    with db_connection() as conn:
+        return conn.execute("SELECT * FROM users WHERE username = ?", (username,)).fetchone()
 
 # -----------------------
 # Patient DB operations
 # -----------------------
 def create_patient(patient_id, name, age, gender, last_visit, notes, created_by):
-    conn = get_connection()
-    cur = conn.cursor()
     try:
-        cur.execute("""
-            INSERT INTO patients (patient_id, name, age, gender, last_visit, notes, created_by)
-            VALUES (?, ?, ?, ?, ?, ?, ?)
-        """, (patient_id, name, age, gender, last_visit, notes, created_by))
-        conn.commit()
+        with db_transaction() as conn:
+            conn.execute("""
+                INSERT INTO patients (patient_id, name, age, gender, last_visit, notes, created_by)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            """, (patient_id, name, age, gender, last_visit, notes, created_by))
+            _bump_total(conn, "patients")
         return True, None
     except sqlite3.IntegrityError as e:
         return False, "Patient ID already exists"
-    finally:
-        conn.close()
 
 def read_patients(limit=200):
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT p.*, u.username AS created_by_username FROM patients p LEFT JOIN users u ON p.created_by = u.id ORDER BY p.id DESC LIMIT ?", (limit,))
-    rows = cur.fetchall()
-    conn.close()
+    with db_connection() as conn:
+        rows = conn.execute("SELECT p.*, u.username AS created_by_username FROM patients p LEFT JOIN users u ON p.created_by = u.id ORDER BY p.id DESC LIMIT ?", (limit,)).fetchall()
     return [dict(r) for r in rows]
 
 def update_patient(row_id, **fields):
-    conn = get_connection()
-    cur = conn.cursor()
     keys = ", ".join([f"{k} = ?" for k in fields.keys()])
     vals = list(fields.values()) + [row_id]
-    cur.execute(f"UPDATE patients SET {keys} WHERE id = ?", vals)
-    conn.commit()
-    conn.close()
+    with db_transaction() as conn:
+        conn.execute(f"UPDATE patients SET {keys} WHERE id = ?", vals)
 
 def delete_patient(row_id):
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute("DELETE FROM patients WHERE id = ?", (row_id,))
-    conn.commit()
-    conn.close()
+    # The patient's summary row goes in the same transaction so the patients page never shows it
+    with db_transaction() as conn:
+        row = conn.execute("SELECT patient_id FROM patients WHERE id = ?", (row_id,)).fetchone()
+        if row is None:
+            return
+        conn.execute("DELETE FROM patients WHERE id = ?", (row_id,))
+        conn.execute("DELETE FROM patient_latest_result WHERE patient_id = ?", (row[0],))
+        _bump_total(conn, "patients", -1)
 
 def get_patient_by_patient_id(patient_id):
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT * FROM patients WHERE patient_id = ?", (patient_id,))
-    row = cur.fetchone()
-    conn.close()
+    with db_connection() as conn:
+        row = conn.execute("SELECT * FROM patients WHERE patient_id = ?", (patient_id,)).fetchone()
     return dict(row) if row else None
 
+# -----------------------
+# Bulk patient import
+# -----------------------
+PATIENT_IMPORT_COLUMNS = ["patient_id", "name", "age", "gender", "last_visit", "notes"]
+GENDER_ALIASES = {"m": "M", "male": "M", "f": "F", "female": "F", "other": "Other", "o": "Other"}
+
+def iter_patient_import_frames(uploaded_file, chunk_rows=IMPORT_BATCH_ROWS):
+    # CSV is read in chunks; Excel has no streaming reader in pandas, so the sheet is read once and sliced
+    if uploaded_file.name.lower().endswith((".xlsx", ".xls")):
+        try:
+            frame = pd.read_excel(uploaded_file, dtype=str, keep_default_na=False)
+        except ImportError as e:
+            engine = "xlrd" if uploaded_file.name.lower().endswith(".xls") else "openpyxl"
+            raise RuntimeError(f"Importing {os.path.splitext(uploaded_file.name)[1]} files requires the {engine} package") from e
+        for start in range(0, len(frame), chunk_rows):
+            yield frame.iloc[start:start + chunk_rows]
+    else:
+        yield from pd.read_csv(uploaded_file, dtype=str, keep_default_na=False, chunksize=chunk_rows)
+
+def validate_patient_rows(frame, first_row_number):
+    # Returns ([(row number, (patient_id, name, age, gender, last_visit, notes))], [(row number, patient_id, problem)]).
+    # Row numbers are spreadsheet line numbers (header = 1). Ages and dates are parsed column-wise.
+    frame = frame.rename(columns=lambda c: str(c).strip().lower().replace(" ", "_"))
+    missing = [c for c in ("patient_id", "name") if c not in frame.columns]
+    if missing:
+        raise ValueError("Missing required column(s): " + ", ".join(missing))
+    frame = frame.reindex(columns=PATIENT_IMPORT_COLUMNS, fill_value="").fillna("").astype(str)
+    ages = pd.to_numeric(frame["age"].str.strip(), errors="coerce")
+    # format="mixed" parses each value on its own, so one odd row cannot make the whole column's
+    # inferred format reject otherwise valid dates
+    visits = pd.to_datetime(frame["last_visit"].str.strip(), errors="coerce", format="mixed", dayfirst=False)
+    valid, errors = [], []
+    for offset, (pid, name, age_raw, gender_raw, visit_raw, notes) in enumerate(frame.itertuples(index=False)):
+        row_number = first_row_number + offset
+        pid, name = pid.strip(), name.strip()
+        age, visit = ages.iat[offset], visits.iat[offset]
+        if not pid or not name:
+            errors.append((row_number, pid, "Patient ID and Name required"))
+        elif age_raw.strip() and (pd.isna(age) or not 0 <= age <= 120 or age != int(age)):
+            errors.append((row_number, pid, f"Invalid age '{age_raw}'"))
+        elif gender_raw.strip() and gender_raw.strip().lower() not in GENDER_ALIASES:
+            errors.append((row_number, pid, f"Invalid gender '{gender_raw}'"))
+        elif visit_raw.strip() and pd.isna(visit):
+            errors.append((row_number, pid, f"Invalid last visit date '{visit_raw}'"))
+        else:
+            valid.append((row_number, (
+                pid, name,
+                int(age) if age_raw.strip() else None,
+                GENDER_ALIASES.get(gender_raw.strip().lower()),
+                visit.strftime("%Y-%m-%d") if visit_raw.strip() else None,
+                notes.strip())))
+    return valid, errors
+
+def import_patients(frames, created_by, progress=None):
+    # Inserts validated rows with one executemany per batch inside BEGIN IMMEDIATE, so the
+    # existing-ID check and the insert see the same state. Duplicates (already in the database
+    # or repeated in the file) and invalid rows are reported per row instead of aborting.
+    report = {"rows": 0, "inserted": 0, "duplicates": [], "errors": []}
+    seen = set()
+    next_row_number = 2
+    for frame in frames:
+        valid, errors = validate_patient_rows(frame, next_row_number)
+        next_row_number += len(frame)
+        report["errors"].extend(errors)
+        batch = []
+        for row_number, rec in valid:
+            if rec[0] in seen:
+                report["duplicates"].append((row_number, rec[0], "Repeated in file"))
+            else:
+                seen.add(rec[0])
+                batch.append((row_number, rec))
+        if batch:
+            with db_transaction() as conn:
+                conn.execute("BEGIN IMMEDIATE")
+                existing = {r[0] for r in conn.execute(
+                    "SELECT patient_id FROM patients WHERE patient_id IN (SELECT value FROM json_each(?))",
+                    (json.dumps([rec[0] for _, rec in batch]),))}
+                before = conn.total_changes
+                conn.executemany("""
+                    INSERT INTO patients (patient_id, name, age, gender, last_visit, notes, created_by)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                    ON CONFLICT(patient_id) DO NOTHING
+                """, [rec + (created_by,) for _, rec in batch if rec[0] not in existing])
+                inserted = conn.total_changes - before
+                if inserted:
+                    _bump_total(conn, "patients", inserted)
+            report["inserted"] += inserted
+            report["duplicates"].extend((n, rec[0], "Patient ID already exists") for n, rec in batch if rec[0] in existing)
+        report["rows"] += len(frame)
+        if progress:
+            progress(report["rows"])
+    return report
+
 # -----------------------
 # Inference logs operations
 # -----------------------
-def log_inference(patient_id, predicted_grade, user_id, orig_image_path, heatmap_path, notes=""):
-    conn = get_connection()
-    cur = conn.cursor()
+def log_inference(patient_id, predicted_grade, user_id, orig_image_path, heatmap_path, notes="", artifacts=()):
+    # Artifact files are written in the background; the row is inserted right away. Blobs still
+    # pending are younger than the GC grace period, and write failures are reported by the writer.
+    persist_artifacts(artifacts)
     timestamp = datetime.utcnow().isoformat()
-    cur.execute("""
-        INSERT INTO inference_logs (patient_id, predicted_grade, timestamp, user_id, orig_image_path, heatmap_path, notes)
-        VALUES (?, ?, ?, ?, ?, ?, ?)
-    """, (patient_id, predicted_grade, timestamp, user_id, orig_image_path, heatmap_path, notes))
-    conn.commit()
-    conn.close()
+    ts_epoch = epoch_from_iso(timestamp)
+    with db_transaction() as conn:
+        cur = conn.execute("""
+            INSERT INTO inference_logs (patient_id, predicted_grade, timestamp, user_id, orig_image_path, heatmap_path, notes, grade_level, ts_epoch)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, (patient_id, predicted_grade, timestamp, user_id, orig_image_path, heatmap_path, notes,
+              grade_level(predicted_grade), ts_epoch))
+        _record_inference_stats(conn, cur.lastrowid, patient_id, predicted_grade, user_id, timestamp, ts_epoch)
 
 def read_inference_logs(limit=100):
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute("""
-        SELECT il.*, u.username AS user_name
-        FROM inference_logs il
-        LEFT JOIN users u ON il.user_id = u.id
-        ORDER BY il.id DESC LIMIT ?
-    """, (limit,))
-    rows = cur.fetchall()
-    conn.close()
+    with db_connection() as conn:
+        rows = conn.execute("""
+            SELECT il.*, u.username AS user_name
+            FROM inference_logs il
+            LEFT JOIN users u ON il.user_id = u.id
+            ORDER BY il.id DESC LIMIT ?
+        """, (limit,)).fetchall()
     return [dict(r) for r in rows]
 
+def inference_log_filters(patient_ids=None, username=None, grade=None, start_date=None, end_date=None):
+    # Returns (WHERE clause, params) over inference_logs il; each filter maps onto an indexed column
+    clauses, params = [], []
+    if patient_ids:
+        clauses.append("il.patient_id IN (SELECT value FROM json_each(?))")
+        params.append(json.dumps(list(patient_ids)))
+    if username:
+        clauses.append("il.user_id = (SELECT id FROM users WHERE username = ?)")
+        params.append(username)
+    if grade:
+        clauses.append("il.grade_level = ?")
+        params.append(grade_level(grade))
+    if start_date:
+        clauses.append("il.ts_epoch >= ?")
+        params.append(epoch_from_iso(start_date.isoformat()))
+    if end_date:
+        clauses.append("il.ts_epoch < ?")
+        params.append(epoch_from_iso((end_date + timedelta(days=1)).isoformat()))
+    return ("WHERE " + " AND ".join(clauses)) if clauses else "", params
+
+def read_inference_logs_page(filters, after_id=None, page_size=50):
+    # Keyset pagination, newest first: the page starts below after_id (None = first page).
+    # Returns (rows, has_more); only page_size + 1 rows are ever read.
+    where, params = filters
+    if after_id is not None:
+        where = (where + " AND " if where else "WHERE ") + "il.id < ?"
+        params = params + [after_id]
+    with db_connection() as conn:
+        rows = conn.execute(f"""
+            SELECT il.*, u.username AS user_name
+            FROM inference_logs il
+            LEFT JOIN users u ON il.user_id = u.id
+            {where}
+            ORDER BY il.id DESC LIMIT ?
+        """, params + [page_size + 1]).fetchall()
+    return [dict(r) for r in rows[:page_size]], len(rows) > page_size
+
+# -----------------------
+# Inference log export (streamed, constant memory)
+# -----------------------
+EXPORT_COLUMNS = ["id", "patient_id", "predicted_grade", "timestamp", "user_name", "orig_image_path",
+                  "heatmap_path", "regenerated_heatmap_path", "notes"]
+EXPORT_FORMATS = {"csv": ".csv", "csv.gz": ".csv.gz", "parquet": ".parquet"}
+
+def iter_inference_log_chunks(filters, chunk_size=EXPORT_CHUNK_ROWS):
+    # Yields lists of row tuples (EXPORT_COLUMNS order), newest first, one keyset query per chunk so
+    # no connection or read snapshot is held for the whole export
+    where, params = filters
+    after_id = None
+    while True:
+        chunk_where, chunk_params = where, list(params)
+        if after_id is not None:
+            chunk_where = (where + " AND " if where else "WHERE ") + "il.id < ?"
+            chunk_params.append(after_id)
+        with db_connection() as conn:
+            rows = conn.execute(f"""
+                SELECT il.id, il.patient_id, il.predicted_grade, il.timestamp, u.username,
+                       il.orig_image_path, il.heatmap_path, il.regenerated_heatmap_path, il.notes
+                FROM inference_logs il
+                LEFT JOIN users u ON il.user_id = u.id
+                {chunk_where}
+                ORDER BY il.id DESC LIMIT ?
+            """, chunk_params + [chunk_size]).fetchall()
+        if not rows:
+            return
+        yield [tuple(r) for r in rows]
+        if len(rows) < chunk_size:
+            return
+        after_id = rows[-1][0]
+
+def _write_csv_chunks(f, chunks, progress):
+    writer = csv.writer(f)
+    writer.writerow(EXPORT_COLUMNS)
+    total = 0
+    for chunk in chunks:
+        writer.writerows(chunk)
+        total += len(chunk)
+        if progress:
+            progress(total)
+    return total
+
+def _write_parquet_chunks(path, chunks, progress):
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError as e:
+        raise RuntimeError("Parquet export requires the pyarrow package") from e
+    schema = pa.schema([("id", pa.int64())] + [(c, pa.string()) for c in EXPORT_COLUMNS[1:]])
+    total = 0
+    with pq.ParquetWriter(path, schema, compression="snappy") as writer:
+        for chunk in chunks:
+            columns = list(zip(*chunk))
+            writer.write_table(pa.Table.from_arrays(
+                [pa.array(col, type=field.type) for col, field in zip(columns, schema)], schema=schema))
+            total += len(chunk)
+            if progress:
+                progress(total)
+        if total == 0:
+            writer.write_table(schema.empty_table())
+    return total
+
+def export_inference_logs(path, fmt, filters, progress=None):
+    # Streams every matching log row to path as csv, csv.gz or parquet; returns the row count
+    chunks = iter_inference_log_chunks(filters)
+    if fmt == "parquet":
+        return _write_parquet_chunks(path, chunks, progress)
+    if fmt == "csv.gz":
+        with gzip.open(path, "wt", newline="", encoding="utf-8") as f:
+            return _write_csv_chunks(f, chunks, progress)
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        return _write_csv_chunks(f, chunks, progress)
+
+class ExportJobs:
+    # Runs exports on a small background pool so large compliance exports survive reruns; each job
+    # writes to its own file under EXPORT_DIR, and files older than EXPORT_TTL_HOURS are removed.
+    def __init__(self, max_workers=2):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="log-export")
+        self._jobs = {}
+        self._lock = threading.Lock()
+        # Sweep exports (and .part leftovers) from earlier processes at startup
+        self._remove_expired()
+
+    def submit(self, fmt, filters):
+        self._remove_expired()
+        os.makedirs(EXPORT_DIR, exist_ok=True)
+        job_id = uuid.uuid4().hex
+        job = {"id": job_id, "format": fmt, "status": "queued", "rows": 0, "error": None, "finished": None,
+               "path": os.path.join(EXPORT_DIR, f"inference_logs_{job_id}{EXPORT_FORMATS[fmt]}")}
+        with self._lock:
+            self._jobs[job_id] = job
+        self._executor.submit(self._run, job, filters)
+        return job_id
+
+    def _run(self, job, filters):
+        job["status"] = "running"
+        tmp_path = job["path"] + ".part"
+        try:
+            job["rows"] = export_inference_logs(tmp_path, job["format"], filters,
+                                                progress=lambda n: job.__setitem__("rows", n))
+            os.replace(tmp_path, job["path"])
+            job["finished"], job["status"] = time.time(), "done"
+        except Exception as e:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            job["finished"], job["error"], job["status"] = time.time(), str(e), "failed"
+
+    def status(self, job_id):
+        self._remove_expired()
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return dict(job) if job else None
+
+    def _remove_expired(self):
+        # Sweeps EXPORT_DIR by mtime rather than the in-memory job table, so files left behind by
+        # restarted or crashed processes are removed too; running jobs' files are never touched
+        cutoff = time.time() - EXPORT_TTL_HOURS * 3600
+        with self._lock:
+            active = set()
+            for job in self._jobs.values():
+                if job["status"] in ("queued", "running"):
+                    active.update((job["path"], job["path"] + ".part"))
+            try:
+                names = os.listdir(EXPORT_DIR)
+            except FileNotFoundError:
+                names = []
+            for name in names:
+                path = os.path.join(EXPORT_DIR, name)
+                try:
+                    if path not in active and os.path.getmtime(path) < cutoff:
+                        os.remove(path)
+                except OSError:
+                    pass
+            for job_id, job in list(self._jobs.items()):
+                if job["status"] == "done" and not os.path.exists(job["path"]) or (
+                        job["status"] == "failed" and job["finished"] < cutoff):
+                    del self._jobs[job_id]
+
+@st.cache_resource
+def get_export_jobs():
+    return ExportJobs()
+
+# -----------------------
+# Analytics queries (aggregated in SQL, no row caps)
+# -----------------------
+def read_patient_summaries():
+    # One row per patient with its X-ray count and latest predicted grade (from patient_latest_result)
+    with db_connection() as conn:
+        rows = conn.execute("""
+            SELECT p.patient_id, p.name, p.age, p.gender, p.last_visit,
+                   u.username AS created_by_username,
+                   COALESCE(lr.xray_count, 0) AS xray_count,
+                   lr.predicted_grade AS latest_grade
+            FROM patients p
+            LEFT JOIN users u ON p.created_by = u.id
+            LEFT JOIN patient_latest_result lr ON lr.patient_id = p.patient_id
+            ORDER BY p.id DESC
+        """).fetchall()
+    return [dict(r) for r in rows]
+
+def read_stats_totals(conn):
+    totals = {r["name"]: r["value"] for r in conn.execute("SELECT name, value FROM stats_totals")}
+    grade_counts = {name[len("grade:"):]: value for name, value in sorted(totals.items())
+                    if name.startswith("grade:") and value > 0}
+    return totals, grade_counts
+
+def read_analytics_stats():
+    with db_connection() as conn:
+        totals, grade_distribution = read_stats_totals(conn)
+        avg_age = conn.execute("SELECT AVG(age) FROM patients").fetchone()[0]
+        gender_distribution = {r[0]: r[1] for r in conn.execute(
+            "SELECT gender, COUNT(*) FROM patients GROUP BY gender")}
+    return {
+        "total_patients": totals.get("patients", 0),
+        "avg_age": int(avg_age) if avg_age is not None else 0,
+        "grade_distribution": grade_distribution,
+        "gender_distribution": gender_distribution,
+    }
+
+def read_dashboard_summary(days=14):
+    # Reads only the summary tables, so cost does not grow with the inference log
+    with db_connection() as conn:
+        totals, grade_counts = read_stats_totals(conn)
+        daily = conn.execute("""
+            SELECT day, SUM(count) FROM stats_daily_grade
+            GROUP BY day ORDER BY day DESC LIMIT ?
+        """, (days,)).fetchall()
+        user_counts = conn.execute("""
+            SELECT COALESCE(u.username, 'Unknown') AS user, sc.count AS inferences
+            FROM stats_user_counts sc LEFT JOIN users u ON sc.user_id = u.id
+            ORDER BY sc.count DESC
+        """).fetchall()
+    return {
+        "total_patients": totals.get("patients", 0),
+        "total_inferences": totals.get("inferences", 0),
+        "grade_counts": grade_counts,
+        "daily_counts": {day: count for day, count in reversed(daily)},
+        "user_counts": [dict(r) for r in user_counts],
+    }
+
+# -----------------------
+# Inference volume timeline (day / week / month buckets over ts_epoch)
+# -----------------------
+TIMELINE_BUCKET_SQL = {
+    "day": "strftime('%Y-%m-%d', ts_epoch, 'unixepoch')",
+    "week": "date(ts_epoch, 'unixepoch', 'weekday 0', '-6 days')",  # Monday of the week
+    "month": "strftime('%Y-%m-01', ts_epoch, 'unixepoch')",
+}
+
+def timeline_bucket_label(bucket, day):
+    if isinstance(day, str):
+        day = date.fromisoformat(day[:10])
+    elif isinstance(day, datetime):
+        day = day.date()
+    if bucket == "week":
+        day = day - timedelta(days=day.weekday())
+    elif bucket == "month":
+        day = day.replace(day=1)
+    return day.isoformat()
+
+def _next_bucket_label(bucket, label):
+    day = date.fromisoformat(label)
+    if bucket == "day":
+        return (day + timedelta(days=1)).isoformat()
+    if bucket == "week":
+        return (day + timedelta(days=7)).isoformat()
+    return (day.replace(year=day.year + 1, month=1) if day.month == 12 else day.replace(month=day.month + 1)).isoformat()
+
+class TimelineCache:
+    # Per-bucket-size series of {label: {grade: count}}. Closed buckets never change (logs are
+    # append-only), so each refresh only re-aggregates rows from the newest, still-open bucket onwards.
+    def __init__(self):
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def series(self, bucket):
+        with self._lock:
+            cached = self._series.setdefault(bucket, {})
+            since = None
+            if cached:
+                open_label = next(reversed(cached))
+                since = datetime.fromisoformat(open_label).replace(tzinfo=timezone.utc).timestamp()
+                del cached[open_label]
+            with db_connection() as conn:
+                rows = conn.execute(f"""
+                    SELECT {TIMELINE_BUCKET_SQL[bucket]} AS bucket, predicted_grade, COUNT(*)
+                    FROM inference_logs
+                    WHERE ts_epoch >= ?
+                    GROUP BY bucket, predicted_grade
+                    ORDER BY bucket
+                """, (since if since is not None else float("-inf"),)).fetchall()
+            for label, grade, count in rows:
+                cached.setdefault(label, {})[grade or "Unknown"] = count
+            return dict(cached)
+
+@st.cache_resource
+def get_timeline_cache():
+    return TimelineCache()
+
+def read_inference_timeline(bucket="month", start=None, end=None, by_grade=False):
+    # Returns one row per bucket between start and end (inclusive, empty buckets filled with 0):
+    # {"bucket": "YYYY-MM-DD", "total": n} plus one count per grade when by_grade is set.
+    if bucket not in TIMELINE_BUCKET_SQL:
+        raise ValueError(f"Unknown timeline bucket: {bucket}")
+    series = get_timeline_cache().series(bucket)
+    if not series and (start is None or end is None):
+        return []
+    first = timeline_bucket_label(bucket, start) if start is not None else next(iter(series))
+    last = timeline_bucket_label(bucket, end) if end is not None else next(reversed(series))
+    timeline = []
+    label = first
+    while label <= last:
+        counts = series.get(label, {})
+        row = {"bucket": label, "total": sum(counts.values())}
+        if by_grade:
+            row.update({grade: counts.get(grade, 0) for grade in CLASSES})
+        timeline.append(row)
+        label = _next_bucket_label(bucket, label)
+    return timeline
+
 # -----------------------
 # Model loading
 # -----------------------
@@ -785,11 +1473,7 @@ def load_model():
         st.warning(f"Model not found at {MODEL_PATH}. Inference disabled.")
         return None
     try:
-        base_model = models.resnet50(pretrained=False)
-        base_model.fc = nn.Linear(base_model.fc.in_features, len(CLASSES))
-        base_model.load_state_dict(torch.load(MODEL_PATH, map_location=DEVICE))
-        base_model.to(DEVICE).eval()
-        return base_model
+        return build_model(MODEL_PATH, shared_weights=MODEL_SHARED_WEIGHTS)
     except Exception as e:
         st.error(f"Model load error: {e}")
         return None
@@ -797,148 +1481,844 @@ def load_model():
 MODEL_AVAILABLE = os.path.exists(MODEL_PATH)
 model = load_model() if MODEL_AVAILABLE else None
 
-transform = T.Compose([
-    T.Resize((224,224)),
-    T.ToTensor(),
-    T.Normalize([0.485,0.456,0.406],[0.229,0.224,0.225])
-])
+@st.cache_resource
+def load_classifier(backend=MODEL_BACKEND):
+    if model is None or backend == "eager":
+        return model
+    try:
+        return load_backend(MODEL_PATH, backend, eager_model=model)
+    except Exception as e:
+        st.warning(f"Model backend '{backend}' unavailable ({e}); falling back to eager PyTorch.")
+        return model
+
+classifier = load_classifier()
+
+@st.cache_resource
+def get_inference_service():
+    if INFERENCE_WORKERS <= 0 or not MODEL_AVAILABLE:
+        return None
+    return InferenceService(MODEL_PATH, workers=INFERENCE_WORKERS, max_pending=INFERENCE_MAX_PENDING,
+                            backend=MODEL_BACKEND, shared_weights=MODEL_SHARED_WEIGHTS)
+
+def gradcam_overlay(rgb224, heatmap):
+    return cv2.addWeighted(rgb224, 0.55, heatmap, 0.45, 0)
 
 # -----------------------
-# Grad-CAM
+# Prediction & heatmap cache
 # -----------------------
-def generate_gradcam(model, x_tensor):
-    model.eval()
-    feature_map = []
-    gradient = []
-
-    def forward_hook(module, input, output):
-        feature_map.append(output)
-
-    def backward_hook(module, grad_in, grad_out):
-        gradient.append(grad_out[0])
-
-    # ResNet50: target the last conv block in layer4
-    target_layer = model.layer4[-1]
-    h1 = target_layer.register_forward_hook(forward_hook)
-    h2 = target_layer.register_full_backward_hook(backward_hook)
-
-    x = x_tensor.clone().requires_grad_(True)
-    out = model(x)
-    cls = out.argmax(dim=1).item()
-    model.zero_grad()
-    out[0, cls].backward()
-
-    h1.remove()
-    h2.remove()
-
-    if not gradient or not feature_map:
-        # Fallback: return a blank heatmap if hooks failed
-        blank = np.zeros((224, 224, 3), dtype=np.uint8)
-        return blank, cls
-
-    pooled_grads = gradient[0].mean(dim=[2, 3], keepdim=True)
-    feat = feature_map[0]
-    cam = (feat * pooled_grads).sum(dim=1, keepdim=False).squeeze().cpu().detach().numpy()
-    cam = np.maximum(cam, 0)
-    if cam.max() > 0:
-        cam = cam / cam.max()
-    cam = cv2.resize(cam, (224, 224))
-    heatmap = cv2.applyColorMap(np.uint8(255 * cam), cv2.COLORMAP_JET)
-    heatmap = cv2.cvtColor(heatmap, cv2.COLOR_BGR2RGB)
-    return heatmap, cls
+class PredictionCache:
+    # Thread-safe LRU of {"grade", "probs", "heatmap"} entries keyed by image + checkpoint hash,
+    # optionally backed by .npz files so results survive restarts and are shared between processes.
+    def __init__(self, max_entries=PREDICTION_CACHE_SIZE, disk_dir=PREDICTION_CACHE_DIR):
+        self.max_entries = max_entries
+        self.disk_dir = disk_dir
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _disk_path(self, key):
+        return os.path.join(self.disk_dir, key[:2], f"{key}.npz")
+
+    def get(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key]
+        if self.disk_dir and os.path.exists(self._disk_path(key)):
+            try:
+                with np.load(self._disk_path(key), allow_pickle=False) as data:
+                    entry = {name: data[name] for name in data.files}
+                entry["grade"] = str(entry["grade"])
+            except (OSError, ValueError, KeyError):
+                return None
+            self._remember(key, entry)
+            return entry
+        return None
+
+    def _remember(self, key, entry):
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def put(self, key, entry):
+        self._remember(key, entry)
+        if self.disk_dir:
+            path = self._disk_path(key)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{threading.get_ident()}.tmp.npz"
+            np.savez_compressed(tmp_path, **{k: np.asarray(v) for k, v in entry.items() if v is not None})
+            os.replace(tmp_path, path)
+
+    def update(self, key, **fields):
+        entry = dict(self.get(key) or {})
+        entry.update(fields)
+        self.put(key, entry)
+        return entry
+
+@st.cache_resource
+def get_prediction_cache():
+    return PredictionCache()
+
+@st.cache_resource
+def model_checkpoint_hash():
+    digest = hashlib.sha256()
+    if os.path.exists(MODEL_PATH):
+        with open(MODEL_PATH, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+def prediction_cache_key(image_digest):
+    return f"{image_digest}-{model_checkpoint_hash()[:16]}-{MODEL_BACKEND}-p{PREPROCESS_VERSION}"
+
+def classify_image(model, rgb224, cache_key, poll=None):
+    entry = get_prediction_cache().get(cache_key)
+    if entry is not None and "probs" in entry:
+        return entry["probs"]
+    service = get_inference_service()
+    if service is not None:
+        probs = service.run("predict", rgb224, poll=poll)
+    else:
+        probs = predict_proba(model, to_model_tensor(rgb224))[0]
+    get_prediction_cache().update(cache_key, grade=CLASSES[int(probs.argmax())], probs=probs)
+    return probs
+
+def explain_image(model, rgb224, cls, cache_key):
+    entry = get_prediction_cache().get(cache_key)
+    if entry is not None and entry.get("heatmap") is not None:
+        return entry["heatmap"]
+    service = get_inference_service()
+    if service is not None:
+        heatmap = service.run("explain", rgb224, target_class=cls)
+    else:
+        heatmap, _ = generate_gradcam(model, to_model_tensor(rgb224), target_class=cls)
+    get_prediction_cache().update(cache_key, heatmap=heatmap)
+    return heatmap
+
+def heatmap_artifact(model, rgb224, cls, cache_key):
+    # Grad-CAM is only computed when the heatmap is actually needed (display, save or report).
+    # Returns (store path, encoded JPEG); nothing is written until the artifact is persisted.
+    return get_artifact_store().encode_image(gradcam_overlay(rgb224, explain_image(model, rgb224, cls, cache_key)))
+
+# -----------------------
+# Content-addressed artifact store
+# -----------------------
+class ArtifactStore:
+    # Images are stored once at <root>/ab/cd/<sha256><ext>, so identical content is deduplicated and
+    # concurrent sessions never overwrite each other. A blob is referenced by every inference_logs
+    # row whose orig_image_path, heatmap_path or regenerated_heatmap_path points at it;
+    # collect_garbage() removes the rest.
+    def __init__(self, root=ARTIFACT_DIR):
+        self.root = root
+
+    def path_for(self, digest, ext):
+        return os.path.join(self.root, digest[:2], digest[2:4], digest + ext)
+
+    def encode_image(self, image, ext=".jpg"):
+        # Returns (path, encoded bytes) without touching the disk
+        params = [cv2.IMWRITE_JPEG_QUALITY, 95] if ext == ".jpg" else []
+        ok, encoded = cv2.imencode(ext, image, params)
+        if not ok:
+            raise ValueError(f"Could not encode image as {ext}")
+        data = encoded.tobytes()
+        return self.path_for(hashlib.sha256(data).hexdigest(), ext), data
+
+    def write(self, path, data, durable=False):
+        if os.path.exists(path):
+            # Refresh mtime so the garbage collector's grace period restarts for re-used blobs
+            os.utime(path)
+            return False
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+            if durable:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+        return True
+
+    def put_image(self, image, ext=".jpg"):
+        path, data = self.encode_image(image, ext)
+        self.write(path, data)
+        return path
+
+    def reference_count(self, conn, path):
+        return conn.execute("""
+            SELECT (SELECT COUNT(*) FROM inference_logs WHERE orig_image_path = ?)
+                 + (SELECT COUNT(*) FROM inference_logs WHERE heatmap_path = ?)
+                 + (SELECT COUNT(*) FROM inference_logs WHERE regenerated_heatmap_path = ?)
+        """, (path, path, path)).fetchone()[0]
+
+    def iter_files(self):
+        for dirpath, _, filenames in os.walk(self.root):
+            for name in filenames:
+                yield os.path.join(dirpath, name)
+
+    def collect_garbage(self, grace_seconds=ARTIFACT_GC_GRACE_SECONDS):
+        # Returns (files removed, bytes freed); also clears temp files left by interrupted writes
+        cutoff = time.time() - grace_seconds
+        removed = freed = 0
+        with db_connection() as conn:
+            for path in self.iter_files():
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                if stat.st_mtime > cutoff:
+                    continue
+                if not path.endswith(".tmp") and self.reference_count(conn, path):
+                    continue
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    continue
+                removed += 1
+                freed += stat.st_size
+        return removed, freed
+
+    def remove_older_than(self, max_age_seconds):
+        # For caches that nothing in the database references: drops files not written or re-used
+        # within max_age_seconds. Returns (files removed, bytes freed).
+        cutoff = time.time() - max_age_seconds
+        removed = freed = 0
+        for path in self.iter_files():
+            try:
+                stat = os.stat(path)
+                if stat.st_mtime > cutoff:
+                    continue
+                os.remove(path)
+            except FileNotFoundError:
+                continue
+            removed += 1
+            freed += stat.st_size
+        return removed, freed
+
+@st.cache_resource
+def get_artifact_store():
+    return ArtifactStore()
+
+class ArtifactWriter:
+    # Background thread that persists encoded artifacts off the request path. Queued blobs are
+    # written in batches of up to max_batch: every file is fsynced before its rename, and each
+    # touched directory is fsynced once per batch so the renames themselves are durable.
+    def __init__(self, store, max_batch=32, max_delay=0.2):
+        self.store = store
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self._queue = queue.Queue()
+        self._pending = {}
+        self._failed = {}
+        self._cond = threading.Condition()
+        threading.Thread(target=self._run, name="artifact-writer", daemon=True).start()
+
+    def submit(self, path, data):
+        with self._cond:
+            if path in self._pending:
+                return
+            self._pending[path] = data
+            self._failed.pop(path, None)
+        self._queue.put(path)
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.max_delay
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self._queue.get(timeout=max(0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+            try:
+                self._write_batch(batch)
+            except Exception as e:
+                # Never let the thread die: fail the whole batch so it is reported
+                with self._cond:
+                    for path in batch:
+                        if self._pending.pop(path, None) is not None:
+                            self._failed[path] = str(e)
+                    self._cond.notify_all()
+                logging.getLogger(__name__).exception("Artifact batch write failed")
+
+    def _write_batch(self, paths):
+        written_dirs, failed = set(), {}
+        for path in paths:
+            try:
+                if self.store.write(path, self._pending[path], durable=True):
+                    written_dirs.add(os.path.dirname(path))
+            except Exception as e:
+                failed[path] = str(e)
+        if hasattr(os, "O_DIRECTORY"):
+            for directory in written_dirs:
+                try:
+                    fd = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+                    try:
+                        os.fsync(fd)
+                    finally:
+                        os.close(fd)
+                except OSError:
+                    pass
+        with self._cond:
+            for path in paths:
+                self._pending.pop(path, None)
+            self._failed.update(failed)
+            self._cond.notify_all()
+        for path, error in failed.items():
+            logging.getLogger(__name__).error("Failed to write artifact %s: %s", path, error)
+
+    def pending(self, path):
+        # Encoded bytes of a queued artifact that is not on disk yet, else None
+        with self._cond:
+            return self._pending.get(path)
+
+    def take_failures(self):
+        # Returns and clears [(path, error)] for writes that failed since the last call
+        with self._cond:
+            failures, self._failed = list(self._failed.items()), {}
+        return failures
+
+    def wait(self, timeout=None):
+        # Blocks until everything queued has been written (used to flush on shutdown)
+        with self._cond:
+            return self._cond.wait_for(lambda: not self._pending, timeout=timeout)
+
+@st.cache_resource
+def get_artifact_writer():
+    writer = ArtifactWriter(get_artifact_store())
+    atexit.register(writer.wait, timeout=10)
+    return writer
+
+def persist_artifacts(artifacts):
+    # artifacts: (path, encoded bytes) pairs from ArtifactStore.encode_image; queued for the writer
+    writer = get_artifact_writer()
+    for path, data in artifacts:
+        writer.submit(path, data)
+
+# -----------------------
+# Upload spooling
+# -----------------------
+@contextmanager
+def spool_upload(fileobj, max_bytes=MAX_UPLOAD_MB * 1024 * 1024):
+    # Streams an upload (or zip member) to a temporary file in 1 MB chunks, hashing as it goes,
+    # and yields (path, sha256 hex). The spool file is removed when the block exits.
+    os.makedirs(UPLOAD_SPOOL_DIR, exist_ok=True)
+    digest = hashlib.sha256()
+    size = 0
+    with tempfile.NamedTemporaryFile(dir=UPLOAD_SPOOL_DIR, suffix=".upload", delete=False) as spool:
+        try:
+            if hasattr(fileobj, "seek"):
+                fileobj.seek(0)
+            for chunk in iter(lambda: fileobj.read(1 << 20), b""):
+                size += len(chunk)
+                if size > max_bytes:
+                    raise ValueError(f"Upload exceeds the {max_bytes // (1024 * 1024)} MB limit")
+                digest.update(chunk)
+                spool.write(chunk)
+        except BaseException:
+            spool.close()
+            os.remove(spool.name)
+            raise
+    try:
+        yield spool.name, digest.hexdigest()
+    finally:
+        os.remove(spool.name)
+
+def load_upload(fileobj, max_side=MAX_IMAGE_SIDE):
+    # Returns (sha256 hex, RGB array capped at max_side). Streamlit already holds the upload in memory;
+    # the spool file exists so the decoder can probe the header and decode from a path.
+    with spool_upload(fileobj) as (path, digest):
+        return digest, decode_image_file(path, max_side=max_side, max_pixels=MAX_IMAGE_PIXELS)
+
+def preview_image(rgb, max_side=PREVIEW_SIDE):
+    # Small copy for st.image so Streamlit does not re-encode and keep the full-resolution array
+    scale = max_side / max(rgb.shape[:2])
+    if scale >= 1:
+        return rgb
+    return cv2.resize(rgb, (round(rgb.shape[1] * scale), round(rgb.shape[0] * scale)), interpolation=cv2.INTER_AREA)
+
+# -----------------------
+# Batch inference
+# -----------------------
+def iter_uploaded_images(uploaded_files):
+    # Yields (name, 224x224 uint8 RGB array, None) for plain uploads and every image inside uploaded
+    # .zip folders, or (name, None, error message) for a file that cannot be read, so one bad file
+    # does not abort the rest of the batch
+    for uploaded_file in uploaded_files:
+        if uploaded_file.name.lower().endswith(".zip"):
+            try:
+                zf = zipfile.ZipFile(uploaded_file)
+            except zipfile.BadZipFile as e:
+                yield uploaded_file.name, None, f"Could not read zip: {e}"
+                continue
+            with zf:
+                for member in zf.infolist():
+                    base_name = os.path.basename(member.filename)
+                    if member.is_dir() or base_name.startswith(".") or not base_name.lower().endswith(IMAGE_EXTENSIONS):
+                        continue
+                    try:
+                        with zf.open(member) as fh:
+                            _, rgb = load_upload(fh)
+                    except (*UPLOAD_ERRORS, zipfile.BadZipFile) as e:
+                        yield member.filename, None, f"Could not read upload: {e}"
+                        continue
+                    yield member.filename, resize_for_model(rgb), None
+        else:
+            try:
+                _, rgb = load_upload(uploaded_file)
+            except UPLOAD_ERRORS as e:
+                yield uploaded_file.name, None, f"Could not read upload: {e}"
+                continue
+            yield uploaded_file.name, resize_for_model(rgb), None
+
+def _classify_stacked(model, names, arrays):
+    probs = predict_proba(model, to_model_tensor(np.stack(arrays)))
+    results = []
+    for name, p in zip(names, probs):
+        cls = int(p.argmax())
+        row = {"file": name, "predicted_grade": CLASSES[cls], "confidence": round(float(p[cls]), 4)}
+        row.update({c: round(float(v), 4) for c, v in zip(CLASSES, p)})
+        results.append(row)
+    return results
+
+def predict_batch(model, named_images, max_batch_size=BATCH_MAX_SIZE, progress=None):
+    # Images arrive already resized to uint8 and are normalized one batch at a time,
+    # so only one batch of model inputs is held in memory at a time.
+    # Unreadable files become rows with an error message and no predicted grade.
+    results, names, arrays = [], [], []
+    for name, rgb224, error in named_images:
+        if error is not None:
+            results.append({"file": name, "predicted_grade": None, "error": error})
+            continue
+        names.append(name)
+        arrays.append(rgb224)
+        if len(arrays) >= max_batch_size:
+            results.extend(_classify_stacked(model, names, arrays))
+            names, arrays = [], []
+            if progress:
+                progress(len(results))
+    if arrays:
+        results.extend(_classify_stacked(model, names, arrays))
+        if progress:
+            progress(len(results))
+    return results
+
+def reexplain_inference_logs(model, logs, max_batch_size=BATCH_MAX_SIZE):
+    # Regenerates Grad-CAM overlays for logged predictions in batches, targeting the logged grade.
+    # The result goes to regenerated_heatmap_path; the audited heatmap_path is never changed.
+    # Returns (overlays written, [(log id, problem)] for originals that could not be read).
+    pending = [log for log in logs if log.get("orig_image_path") and log.get("predicted_grade") in CLASSES]
+    done, skipped = 0, []
+    for start in range(0, len(pending), max_batch_size):
+        chunk, arrays = [], []
+        for log in pending[start:start + max_batch_size]:
+            try:
+                rgb = decode_image_file(log["orig_image_path"], max_side=MAX_IMAGE_SIDE, max_pixels=MAX_IMAGE_PIXELS)
+            except UPLOAD_ERRORS as e:
+                skipped.append((log["id"], str(e)))
+                continue
+            chunk.append(log)
+            arrays.append(resize_for_model(rgb))
+        if not chunk:
+            continue
+        batch = np.stack(arrays)
+        heatmaps, _, _ = generate_gradcam_batch(model, to_model_tensor(batch), target_classes=[CLASSES.index(log["predicted_grade"]) for log in chunk])
+        # New overlays get new content addresses; the superseded blobs are left to the garbage collector
+        updates = [(get_artifact_store().put_image(gradcam_overlay(rgb224, heatmap)), log["id"])
+                   for log, rgb224, heatmap in zip(chunk, batch, heatmaps[:, 0])]
+        with db_transaction() as conn:
+            conn.executemany("UPDATE inference_logs SET regenerated_heatmap_path = ? WHERE id = ?", updates)
+        done += len(updates)
+    return done, skipped
+
+def summarize_batch(results):
+    # Error rows have no predicted grade, so value_counts() leaves them out of the summary
+    df = pd.DataFrame(results)
+    grade_counts = df["predicted_grade"].value_counts().reindex(CLASSES, fill_value=0)
+    return df, grade_counts.rename_axis("Grade").reset_index(name="Images")
 
 # -----------------------
 # PDF report generator
 # -----------------------
-def generate_pdf_report(predicted_grade, orig_path, heatmap_path, patient_info=None):
-    pdf = FPDF()
-    pdf.add_page()
-    pdf.set_font("Arial", "B", 16)
-    pdf.cell(200, 10, txt="OA Detection Report", ln=True, align="C")
-    pdf.ln(10)
-    pdf.set_font("Arial", size=12)
+class ReportTemplate(FPDF):
+    # Fixed report layout; one document can hold many report pages (bulk merged export), and
+    # FPDF embeds each image file only once however many pages reference it
+    def header(self):
+        self.set_font("Arial", "B", 16)
+        self.cell(200, 10, txt="OA Detection Report", ln=True, align="C")
+        self.ln(10)
+
+    def add_report(self, report):
+        self.add_page()
+        self.set_font("Arial", size=12)
+        if report.get("patient_id") is not None:
+            self.cell(200, 10, txt=_pdf_text(f"Patient ID: {report.get('patient_id') or 'N/A'}"), ln=True)
+            self.cell(200, 10, txt=_pdf_text(f"Name: {report.get('name') or 'N/A'}"), ln=True)
+        self.cell(200, 10, txt=_pdf_text(f"Predicted Grade: {report['predicted_grade']}"), ln=True)
+        self.cell(200, 10, txt=f"Timestamp: {report.get('timestamp') or datetime.utcnow().isoformat()}", ln=True)
+        self.ln(10)
+        y = self.get_y()
+        if report.get("orig_image"):
+            self.image(report["orig_image"], x=10, y=y, w=90)
+        if report.get("heatmap_image"):
+            self.image(report["heatmap_image"], x=110, y=y, w=90)
+
+    def to_bytes(self):
+        out = self.output(dest="S")
+        return out.encode("latin-1") if isinstance(out, str) else bytes(out)
+
+def _pdf_text(value):
+    # Core PDF fonts are latin-1 only; replace anything else rather than failing a bulk export
+    return str(value).encode("latin-1", "replace").decode("latin-1")
+
+@st.cache_resource
+def get_report_image_store():
+    return ArtifactStore(REPORT_IMAGE_DIR)
+
+def _content_digest(path):
+    # Artifact store paths are named by their SHA-256; anything else is hashed from its bytes
+    stem = os.path.splitext(os.path.basename(path))[0]
+    if len(stem) == 64 and all(c in "0123456789abcdef" for c in stem):
+        return stem
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def report_image(path):
+    # Path of a downscaled JPEG copy of path for embedding, built once per source content. An
+    # artifact still queued for the background writer is read from its pending bytes.
+    if not path:
+        return None
+    data = None
+    if not os.path.exists(path):
+        data = get_artifact_writer().pending(path)
+        if data is None and not os.path.exists(path):  # it may have been written in between
+            return None
+    store = get_report_image_store()
+    cached = store.path_for(_content_digest(path), ".jpg")
+    try:
+        os.utime(cached)  # keeps recently used copies out of prune_report_images()
+        return cached
+    except FileNotFoundError:
+        pass
+    if data is None:
+        image = cv2.imread(path, cv2.IMREAD_COLOR)
+    else:
+        image = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+    if image is None:
+        return None
+    if data is None and image.shape[1] <= REPORT_IMAGE_WIDTH and path.lower().endswith((".jpg", ".jpeg")):
+        return path
+    if image.shape[1] > REPORT_IMAGE_WIDTH:
+        height = max(1, round(image.shape[0] * REPORT_IMAGE_WIDTH / image.shape[1]))
+        image = cv2.resize(image, (REPORT_IMAGE_WIDTH, height), interpolation=cv2.INTER_AREA)
+    ok, encoded = cv2.imencode(".jpg", image, [cv2.IMWRITE_JPEG_QUALITY, 85])
+    if not ok:
+        return None
+    store.write(cached, encoded.tobytes())
+    return cached
+
+def prune_report_images(max_age_hours=REPORT_IMAGE_TTL_HOURS):
+    # Downscaled copies are rebuilt on demand, so any not used for max_age_hours can go
+    return get_report_image_store().remove_older_than(max_age_hours * 3600)
+
+def clean_up_storage():
+    # Returns (files removed, bytes freed) across unreferenced artifacts and stale report images
+    n_removed, n_bytes = get_artifact_store().collect_garbage()
+    n_report_images, n_report_bytes = prune_report_images()
+    return n_removed + n_report_images, n_bytes + n_report_bytes
+
+@st.cache_resource
+def start_storage_cleanup_schedule():
+    # One background sweep per process every STORAGE_CLEANUP_INTERVAL_HOURS, so deleting files
+    # never depends on someone pressing a button
+    if STORAGE_CLEANUP_INTERVAL_HOURS <= 0:
+        return None
+    def run():
+        while True:
+            time.sleep(STORAGE_CLEANUP_INTERVAL_HOURS * 3600)
+            try:
+                clean_up_storage()
+            except Exception:
+                logging.getLogger(__name__).exception("Scheduled storage cleanup failed")
+    thread = threading.Thread(target=run, name="storage-cleanup", daemon=True)
+    thread.start()
+    return thread
+
+start_storage_cleanup_schedule()
+
+def prepare_report(report):
+    return dict(report, orig_image=report_image(report.get("orig_image_path")),
+                heatmap_image=report_image(report.get("heatmap_path")))
+
+def generate_pdf_report(predicted_grade, orig_path, heatmap_path, patient_info=None, timestamp=None):
+    # Returns the PDF as bytes; nothing is written besides the cached report images
+    report = {"predicted_grade": predicted_grade, "orig_image_path": orig_path, "heatmap_path": heatmap_path,
+              "timestamp": timestamp}
     if patient_info:
-        pdf.cell(200, 10, txt=f"Patient ID: {patient_info.get('patient_id','N/A')}", ln=True)
-        pdf.cell(200, 10, txt=f"Name: {patient_info.get('name','N/A')}", ln=True)
-    pdf.cell(200, 10, txt=f"Predicted Grade: {predicted_grade}", ln=True)
-    pdf.cell(200, 10, txt=f"Timestamp: {datetime.utcnow().isoformat()}", ln=True)
-    pdf.ln(10)
-    if os.path.exists(orig_path):
-        pdf.image(orig_path, x=10, y=None, w=90)
-    if os.path.exists(heatmap_path):
-        pdf.image(heatmap_path, x=110, y=None, w=90)
-    os.makedirs("tmp", exist_ok=True)
-    out_path = f"tmp/report_{datetime.utcnow().strftime('%Y%m%d%H%M%S')}.pdf"
-    pdf.output(out_path)
-    return out_path
+        report.update(patient_id=patient_info.get("patient_id"), name=patient_info.get("name"))
+    pdf = ReportTemplate()
+    pdf.add_report(prepare_report(report))
+    return pdf.to_bytes()
+
+def read_report_logs(patient_ids=None, start_date=None, end_date=None):
+    # Inference logs to report on, optionally restricted to patients and an inclusive date range
+    where, params = inference_log_filters(patient_ids, start_date=start_date, end_date=end_date)
+    with db_connection() as conn:
+        rows = conn.execute(f"""
+            SELECT il.id, il.patient_id, p.name, il.predicted_grade, il.timestamp,
+                   il.orig_image_path, il.heatmap_path
+            FROM inference_logs il
+            LEFT JOIN patients p ON p.patient_id = il.patient_id
+            {where}
+            ORDER BY il.patient_id, il.ts_epoch
+        """, params).fetchall()
+    return [dict(r) for r in rows]
+
+def _report_file_name(report):
+    safe_id = "".join(c if c.isalnum() or c in "-_" else "_" for c in str(report.get("patient_id") or "unassigned"))
+    return f"OA_report_{safe_id}_{report['id']}.pdf"
+
+def _render_report(report):
+    pdf = ReportTemplate()
+    pdf.add_report(prepare_report(report))
+    return _report_file_name(report), pdf.to_bytes()
+
+def generate_bulk_reports(reports, output="pdf", workers=REPORT_WORKERS, progress=None):
+    # output="pdf": one merged document with a page per report; output="zip": one PDF per report.
+    # Image decoding/downscaling (cv2 releases the GIL) and zip-mode rendering run on a thread pool.
+    prune_report_images()
+    buf = io.BytesIO()
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        if output == "pdf":
+            pdf = ReportTemplate()
+            for done, report in enumerate(pool.map(prepare_report, reports), 1):
+                pdf.add_report(report)
+                if progress:
+                    progress(done)
+            buf.write(pdf.to_bytes())
+        else:
+            with zipfile.ZipFile(buf, "w", zipfile.ZIP_STORED) as zf:
+                for done, (name, data) in enumerate(pool.map(_render_report, reports), 1):
+                    zf.writestr(name, data)
+                    if progress:
+                        progress(done)
+    return buf.getvalue()
+
+# -----------------------
+# Chat Assistant helpers
+# -----------------------
+@st.cache_resource
+def get_llm_gateway():
+    # Every chat API call goes through this gateway; it owns retries, so the client itself does not retry
+    client = ChatClient(GROQ_BASE_URL, connect_timeout=GROQ_CONNECT_TIMEOUT, read_timeout=GROQ_READ_TIMEOUT,
+                        retries=0, pool_size=max(LLM_MAX_IN_FLIGHT, 1))
+    return LLMGateway(client, max_in_flight=LLM_MAX_IN_FLIGHT, rate_per_minute=LLM_RATE_PER_MINUTE,
+                      burst=LLM_BURST, retries=GROQ_RETRIES, queue_timeout=LLM_QUEUE_TIMEOUT,
+                      breaker_threshold=LLM_BREAKER_FAILURES, breaker_cooldown=LLM_BREAKER_COOLDOWN)
+
+def chat_session_id():
+    if "chat_session_id" not in st.session_state:
+        st.session_state["chat_session_id"] = uuid.uuid4().hex
+    return st.session_state["chat_session_id"]
+
+def summarize_chat_turns(api_key, previous_summary, turns, max_words):
+    transcript = "\n".join(f"{m['role']}: {m['content']}" for m in turns)
+    return get_llm_gateway().complete(chat_session_id(), api_key, [
+        {"role": "system", "content": SUMMARY_INSTRUCTIONS.format(words=max_words)},
+        {"role": "user", "content": f"Previous summary:\n{previous_summary or '(none)'}\n\nNew turns:\n{transcript}"},
+    ], model=GROQ_MODEL, temperature=0.2, max_tokens=max_words * 2)
+
+def build_chat_messages(api_key, history, xray_context=None):
+    # Sliding window of recent turns plus a running summary kept in the session; the X-ray context
+    # is sent once as a system message however many times it was discussed
+    context = None
+    if xray_context:
+        context = f"Current patient context: X-ray shows {xray_context['predicted_grade']} for patient {xray_context['patient_id']}"
+    window = ChatContextWindow(CHAT_SYSTEM_PROMPT, max_tokens=CHAT_CONTEXT_TOKENS, reply_tokens=CHAT_REPLY_TOKENS)
+    messages, summary = window.build(
+        [{"role": msg["role"], "content": msg["content"]} for msg in history],
+        st.session_state.get("chat_summary"), context,
+        summarize=lambda previous, turns, words: summarize_chat_turns(api_key, previous, turns, words))
+    st.session_state["chat_summary"] = summary
+    return messages
+
+def chat_message_html(role, content):
+    if role == "user":
+        return f"""
+            <div class="chat-message user-message">
+                <div class="message-header">👤 You</div>
+                <div class="message-content">{content}</div>
+            </div>
+            """
+    return f"""
+            <div class="chat-message bot-message">
+                <div class="message-header">🤖 AI Medical Assistant</div>
+                <div class="message-content">{content}</div>
+            </div>
+            """
+
+def grade_analysis_prompt(grade, description, patient_id=None):
+    patient_line = f"Patient ID: {patient_id}\n" if patient_id else ""
+    return f"""I have an X-ray scan result showing {grade}. 
+                
+{patient_line}Diagnosis: {grade}
+Severity: {description}
+
+Please provide:
+1. A brief explanation of what this grade means
+2. Potential health implications
+3. Recommended lifestyle changes or treatments
+4. When to seek immediate medical attention
+
+Keep your response professional, clear, and compassionate."""
+
+def cacheable_chat_messages(prompt):
+    # Cached prompts are answered without conversation history so one reply serves every session
+    return [{"role": "system", "content": CHAT_SYSTEM_PROMPT}, {"role": "user", "content": prompt}]
+
+class ResponseCache:
+    # Replies to context-free prompts, shared by all sessions and persisted in SQLite. Keys hash the
+    # normalized prompt, model and temperature; entries expire after ttl_seconds and the least
+    # recently used rows beyond max_entries are evicted on insert.
+    def __init__(self, ttl_seconds=CHAT_CACHE_TTL_HOURS * 3600, max_entries=CHAT_CACHE_MAX_ENTRIES):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+
+    @staticmethod
+    def normalize(prompt):
+        return " ".join(prompt.lower().split()).rstrip("?!. ")
+
+    def key(self, prompt, model, temperature):
+        raw = json.dumps([self.normalize(prompt), model, round(float(temperature), 3)])
+        return hashlib.sha256(raw.encode()).hexdigest()
+
+    def get(self, prompt, model, temperature):
+        now = time.time()
+        key = self.key(prompt, model, temperature)
+        with db_transaction() as conn:
+            if not conn.execute("""
+                UPDATE llm_response_cache SET hits = hits + 1, last_used_at = ?
+                WHERE cache_key = ? AND created_at >= ?
+            """, (now, key, now - self.ttl_seconds)).rowcount:
+                return None
+            return conn.execute("SELECT response FROM llm_response_cache WHERE cache_key = ?", (key,)).fetchone()[0]
+
+    def put(self, prompt, model, temperature, response):
+        now = time.time()
+        with db_transaction() as conn:
+            conn.execute("""
+                INSERT INTO llm_response_cache (cache_key, model, temperature, prompt, response, created_at, last_used_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(cache_key) DO UPDATE SET
+                    response = excluded.response, created_at = excluded.created_at, last_used_at = excluded.last_used_at
+            """, (self.key(prompt, model, temperature), model, float(temperature), prompt, response, now, now))
+            conn.execute("DELETE FROM llm_response_cache WHERE created_at < ?", (now - self.ttl_seconds,))
+            conn.execute("""
+                DELETE FROM llm_response_cache WHERE cache_key IN (
+                    SELECT cache_key FROM llm_response_cache ORDER BY last_used_at DESC LIMIT -1 OFFSET ?)
+            """, (self.max_entries,))
+
+@st.cache_resource
+def get_response_cache():
+    return ResponseCache()
+
+def chat_prewarm_prompts():
+    return [grade_analysis_prompt(grade, GRADE_SEVERITY[grade.split()[-1]][1]) for grade in CLASSES] + CHAT_QUICK_QUESTIONS
+
+@st.cache_resource
+def start_chat_cache_prewarm():
+    # Fills missing per-grade explanations and quick-question answers once per process, in the background
+    if not GROQ_API_KEY:
+        return None
+    def prewarm(cache, gateway):
+        # A failure only stops the prewarm; the missing answers are fetched on demand instead
+        try:
+            for prompt in chat_prewarm_prompts():
+                if cache.get(prompt, GROQ_MODEL, CHAT_TEMPERATURE) is not None:
+                    continue
+                reply = gateway.complete("prewarm", GROQ_API_KEY, cacheable_chat_messages(prompt), model=GROQ_MODEL,
+                                         temperature=CHAT_TEMPERATURE, max_tokens=CHAT_REPLY_TOKENS)
+                cache.put(prompt, GROQ_MODEL, CHAT_TEMPERATURE, reply)
+        except Exception:
+            logging.getLogger(__name__).exception("Chat cache prewarm stopped")
+    thread = threading.Thread(target=prewarm, args=(get_response_cache(), get_llm_gateway()),
+                              name="chat-cache-prewarm", daemon=True)
+    thread.start()
+    return thread
+
+start_chat_cache_prewarm()
+
+def stream_chat_reply(api_key, messages, placeholder, min_interval=0.05):
+    # Renders tokens into placeholder as they arrive (throttled) and returns the full reply
+    parts, last_render = [], 0.0
+    for delta in get_llm_gateway().stream(chat_session_id(), api_key, messages, model=GROQ_MODEL,
+                                          temperature=CHAT_TEMPERATURE, max_tokens=CHAT_REPLY_TOKENS):
+        parts.append(delta)
+        if time.monotonic() - last_render >= min_interval:
+            placeholder.markdown(chat_message_html("assistant", "".join(parts) + "▌"), unsafe_allow_html=True)
+            last_render = time.monotonic()
+    reply = "".join(parts)
+    placeholder.markdown(chat_message_html("assistant", reply), unsafe_allow_html=True)
+    return reply
 
 # -----------------------
 # Generate Analytics Dashboard HTML with Real Data
 # -----------------------
+DIAGNOSIS_MAP = {
+    "Grade 0": "Normal",
+    "Grade 1": "Mild Osteopenia",
+    "Grade 2": "Moderate Osteopenia",
+    "Grade 3": "Severe Osteopenia",
+    "Grade 4": "Osteoporosis"
+}
+
+# BMD score based on grade (simulated)
+BMD_SCORES = {"Grade 0": "-0.5", "Grade 1": "-1.2", "Grade 2": "-1.8", "Grade 3": "-2.3", "Grade 4": "-2.9"}
+
 def generate_analytics_dashboard():
-    # Get real data from database
-    patients = read_patients(limit=1000)
-    logs = read_inference_logs(limit=1000)
+    # Get real data from database (per-patient latest grade and counts come from SQL aggregates)
+    patients = read_patient_summaries()
+    stats = read_analytics_stats()
     
     # Prepare data for dashboard
     dashboard_patients = []
     for i, patient in enumerate(patients):
-        # Get patient's latest inference
-        patient_logs = [log for log in logs if log['patient_id'] == patient['patient_id']]
-        latest_log = patient_logs[0] if patient_logs else None
-        
-        # Map grade to diagnosis
-        diagnosis_map = {
-            "Grade 0": "Normal",
-            "Grade 1": "Mild Osteopenia",
-            "Grade 2": "Moderate Osteopenia",
-            "Grade 3": "Severe Osteopenia",
-            "Grade 4": "Osteoporosis"
-        }
-        
-        diagnosis = diagnosis_map.get(latest_log['predicted_grade'], "Not Diagnosed") if latest_log else "Not Diagnosed"
-        
-        # Generate BMD score based on grade (simulated)
-        bmd_scores = {"Grade 0": "-0.5", "Grade 1": "-1.2", "Grade 2": "-1.8", "Grade 3": "-2.3", "Grade 4": "-2.9"}
-        bmd_score = bmd_scores.get(latest_log['predicted_grade'], "N/A") if latest_log else "N/A"
-        
+        latest_grade = patient['latest_grade']
         dashboard_patients.append({
             "id": patient['patient_id'],
             "serialNo": f"S{i+1:03d}",
             "name": patient['name'],
             "age": patient['age'],
             "gender": patient['gender'],
-            "bmdScore": bmd_score,
-            "diagnosis": diagnosis,
-            "xrayCount": len(patient_logs),
+            "bmdScore": BMD_SCORES.get(latest_grade, "N/A"),
+            "diagnosis": DIAGNOSIS_MAP.get(latest_grade, "Not Diagnosed"),
+            "xrayCount": patient['xray_count'],
             "date": patient['last_visit'],
-            "diagnosedBy": patient.get('created_by_username', 'Unknown')
+            "diagnosedBy": patient.get('created_by_username') or 'Unknown'
         })
     
     # Calculate statistics
-    total_patients = len(patients)
+    total_patients = stats["total_patients"]
     severe_cases = len([p for p in dashboard_patients if p['diagnosis'] in ['Severe Osteopenia', 'Osteoporosis']])
     total_xrays = sum([p['xrayCount'] for p in dashboard_patients])
-    avg_age = int(sum([p['age'] for p in dashboard_patients]) / len(dashboard_patients)) if dashboard_patients else 0
+    avg_age = stats["avg_age"]
     
     # Grade distribution
-    grade_distribution = {}
-    for log in logs:
-        grade = log['predicted_grade']
-        grade_distribution[grade] = grade_distribution.get(grade, 0) + 1
+    grade_distribution = stats["grade_distribution"]
     
     # Gender distribution
     gender_distribution = {"M": 0, "F": 0, "Other": 0}
-    for patient in patients:
-        gender_distribution[patient['gender']] = gender_distribution.get(patient['gender'], 0) + 1
+    gender_distribution.update(stats["gender_distribution"])
     
-    # Generate timeline data
-    timeline_data = []
-    months = ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']
-    cumulative = 0
-    for month in months:
-        cumulative += np.random.randint(5, 15)
-        timeline_data.append(cumulative)
+    # Timeline data: real monthly X-ray volume over the last 12 months
+    today = datetime.utcnow().date()
+    first_month = date(today.year, 1, 1) if today.month == 12 else date(today.year - 1, today.month + 1, 1)
+    timeline = read_inference_timeline("month", start=first_month, end=today)
+    timeline_labels = [datetime.fromisoformat(row["bucket"]).strftime("%b %Y") for row in timeline]
+    timeline_data = [row["total"] for row in timeline]
     
     patients_json = json.dumps(dashboard_patients)
     
@@ -1156,7 +2536,7 @@ def generate_analytics_dashboard():
                     new Chart(lineCtx, {{
                         type: 'line',
                         data: {{
-                            labels: ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec'],
+                            labels: {json.dumps(timeline_labels)},
                             datasets: [{{
                                 label: 'X-rays Processed',
                                 data: timelineData,
@@ -1281,7 +2661,7 @@ def generate_analytics_dashboard():
                         </div>
 
                         <div className="dashboard-card mb-8">
-                            <h3 className="text-xl font-bold mb-4">X-ray Production Over Time (2024)</h3>
+                            <h3 className="text-xl font-bold mb-4">X-ray Production Over Time (Last 12 Months)</h3>
                             <div style={{{{ height: '300px' }}}}>
                                 <canvas ref={{lineChartRef}}></canvas>
                             </div>
@@ -1570,22 +2950,18 @@ choice = st.session_state["current_page"]
 if choice == "Dashboard":
     st.markdown("# 🏥 OA Premium Dashboard")
     
-    # Get data
-    patients = read_patients(limit=1000)
-    logs = read_inference_logs(limit=1000)
+    # Get data (pre-aggregated summary tables + the 10 most recent logs)
+    summary = read_dashboard_summary()
     
     # Calculate statistics
-    total_patients = len(patients)
-    total_inferences = len(logs)
+    total_patients = summary["total_patients"]
+    total_inferences = summary["total_inferences"]
     
     # Grade distribution for chart
-    grade_counts = {}
-    for log in logs:
-        grade = log['predicted_grade']
-        grade_counts[grade] = grade_counts.get(grade, 0) + 1
+    grade_counts = summary["grade_counts"]
     
     # Recent activity
-    recent_logs = logs[:10] if logs else []
+    recent_logs = read_inference_logs(limit=10)
     
     # Futuristic Stats Cards with HTML
     st.markdown("""
@@ -1927,15 +3303,11 @@ if choice == "Dashboard":
     with col2:
         st.markdown('<div class="chart-container">', unsafe_allow_html=True)
         st.markdown("### 📈 Inference Trend")
-        if logs:
-            # Create activity trend chart
-            log_dates = [log['timestamp'][:10] for log in logs]
-            date_counts = {}
-            for date in log_dates:
-                date_counts[date] = date_counts.get(date, 0) + 1
-            
-            sorted_dates = sorted(date_counts.keys())[-14:]  # Last 14 days
-            counts = [date_counts[date] for date in sorted_dates]
+        date_counts = summary["daily_counts"]
+        if date_counts:
+            # Create activity trend chart (last 14 days with activity)
+            sorted_dates = list(date_counts.keys())
+            counts = list(date_counts.values())
             
             fig = go.Figure(data=[go.Scatter(
                 x=sorted_dates,
@@ -1997,16 +3369,88 @@ if choice == "Dashboard":
         st.info("No recent inference logs available")
     
     st.markdown('</div>', unsafe_allow_html=True)
+    
+    if summary["user_counts"]:
+        st.markdown("### 👤 Inferences by User")
+        st.dataframe(pd.DataFrame(summary["user_counts"]), use_container_width=True)
 
 elif choice == "Inference Logs":
     st.subheader("Inference Logs (who ran what & when)")
-    logs = read_inference_logs(limit=500)
+    c1, c2, c3, c4 = st.columns(4)
+    with c1:
+        log_patients = st.text_input("Patient ID(s)", placeholder="comma-separated")
+    with c2:
+        log_user = st.text_input("User")
+    with c3:
+        log_grade = st.selectbox("Grade", ["All"] + CLASSES)
+    with c4:
+        page_size = st.selectbox("Rows per page", [25, 50, 100, 200], index=1)
+    log_start = log_end = None
+    if st.checkbox("Filter by date"):
+        d1, d2 = st.columns(2)
+        with d1:
+            log_start = st.date_input("From", value=date.today() - timedelta(days=30), key="log_start")
+        with d2:
+            log_end = st.date_input("To", value=date.today(), key="log_end")
+    filters = inference_log_filters(
+        [p.strip() for p in log_patients.split(",") if p.strip()], log_user.strip() or None,
+        None if log_grade == "All" else log_grade, log_start, log_end)
+
+    # Page cursors (the id each visited page starts below); reset whenever the filters change
+    filter_key = (filters[0], tuple(filters[1]), page_size)
+    if st.session_state.get("log_filter_key") != filter_key:
+        st.session_state["log_filter_key"] = filter_key
+        st.session_state["log_cursors"] = [None]
+    cursors = st.session_state["log_cursors"]
+    logs, has_more = read_inference_logs_page(filters, cursors[-1], page_size)
     if logs:
         df = pd.DataFrame(logs)
         st.dataframe(df, use_container_width=True)
-        if st.button("Download CSV"):
-            csv = df.to_csv(index=False)
-            st.download_button("⬇ Download", csv, file_name="inference_logs.csv")
+        p1, p2, p3 = st.columns([1, 2, 1])
+        with p1:
+            if len(cursors) > 1 and st.button("◀ Newer"):
+                cursors.pop()
+                st.rerun()
+        with p2:
+            st.caption(f"Page {len(cursors)} · {len(logs)} rows")
+        with p3:
+            if has_more and st.button("Older ▶"):
+                cursors.append(logs[-1]["id"])
+                st.rerun()
+        if MODEL_AVAILABLE and model is not None and st.session_state["user"] is not None and st.button(
+                "Regenerate Grad-CAM heatmaps for this page",
+                help="Stored as regenerated_heatmap_path; the logged heatmap is kept unchanged"):
+            with st.spinner("Re-explaining logged predictions..."):
+                n_done, skipped = reexplain_inference_logs(model, logs)
+            st.success(f"Regenerated {n_done} heatmaps")
+            if skipped:
+                st.warning(f"Skipped {len(skipped)} log(s) whose original image could not be read")
+                st.dataframe(pd.DataFrame(skipped, columns=["log id", "error"]), use_container_width=True)
+        st.markdown("### Export all matching logs")
+        e1, e2 = st.columns([2, 1])
+        with e1:
+            export_format = st.radio("Format", list(EXPORT_FORMATS), horizontal=True)
+        with e2:
+            if st.button("Start export"):
+                st.session_state["log_export_job"] = get_export_jobs().submit(export_format, filters)
+        export_job = get_export_jobs().status(st.session_state.get("log_export_job"))
+        if export_job:
+            if export_job["status"] in ("queued", "running"):
+                st.info(f"Export {export_job['status']}: {export_job['rows']:,} rows written")
+                st.button("Refresh export status")
+            elif export_job["status"] == "failed":
+                st.error(f"Export failed: {export_job['error']}")
+            elif os.path.exists(export_job["path"]):
+                st.success(f"Export ready: {export_job['rows']:,} rows")
+                # The file is only read (and handed to Streamlit) once the user asks for it, not on every rerun
+                prepared = st.session_state.get("log_export_prepared") == export_job["id"]
+                if not prepared and st.button("Prepare download"):
+                    st.session_state["log_export_prepared"] = export_job["id"]
+                    prepared = True
+                if prepared:
+                    with open(export_job["path"], "rb") as f:
+                        st.download_button("⬇ Download export", f, file_name=os.path.basename(export_job["path"]),
+                                           on_click=lambda: st.session_state.pop("log_export_prepared", None))
     else:
         st.info("No logs found.")
 
@@ -2058,31 +3502,122 @@ elif choice == "Patients":
                     delete_patient(sel_id)
                     st.success("Deleted")
 
+        st.markdown("### Bulk import patients")
+        import_file = st.file_uploader("CSV or Excel with columns patient_id, name, age, gender, last_visit, notes",
+                                       type=["csv", "xlsx", "xls"], key="patient_import")
+        if import_file is not None and st.button("Import patients"):
+            progress_text = st.empty()
+            try:
+                with st.spinner("Importing patients..."):
+                    report = import_patients(iter_patient_import_frames(import_file), st.session_state["user"]["id"],
+                                             progress=lambda n: progress_text.text(f"Processed {n:,} rows"))
+            except (ValueError, RuntimeError) as e:
+                st.error(f"Import failed: {e}")
+            else:
+                st.success(f"Imported {report['inserted']:,} of {report['rows']:,} rows")
+                problems = ([{"row": n, "patient_id": pid, "problem": why} for n, pid, why in report["duplicates"]]
+                            + [{"row": n, "patient_id": pid, "problem": why} for n, pid, why in report["errors"]])
+                if problems:
+                    problems_df = pd.DataFrame(problems).sort_values("row")
+                    st.warning(f"{len(report['duplicates']):,} duplicates and {len(report['errors']):,} invalid rows were skipped")
+                    st.dataframe(problems_df.head(1000), use_container_width=True)
+                    st.download_button("⬇ Download skipped rows", problems_df.to_csv(index=False),
+                                       file_name="patient_import_skipped.csv")
+
+        st.markdown("### Bulk PDF reports")
+        with st.form("bulk_reports"):
+            bulk_ids = st.text_area("Patient IDs (one per line or comma-separated; leave empty for all patients)")
+            c1, c2 = st.columns(2)
+            with c1:
+                bulk_start = st.date_input("From", value=date.today().replace(day=1))
+            with c2:
+                bulk_end = st.date_input("To", value=date.today())
+            bulk_output = st.radio("Output", ("Merged PDF", "Zip of PDFs"), horizontal=True)
+            bulk_submit = st.form_submit_button("Generate reports")
+        if bulk_submit:
+            patient_ids = [p.strip() for p in bulk_ids.replace(",", "\n").splitlines() if p.strip()]
+            reports = read_report_logs(patient_ids, bulk_start, bulk_end)
+            if not reports:
+                st.info("No inference logs match these patients and dates.")
+            else:
+                progress_bar = st.progress(0.0)
+                output = "pdf" if bulk_output == "Merged PDF" else "zip"
+                with st.spinner(f"Rendering {len(reports)} reports..."):
+                    bulk_data = generate_bulk_reports(reports, output=output,
+                                                      progress=lambda n: progress_bar.progress(n / len(reports)))
+                st.download_button(f"⬇ Download {len(reports)} reports", bulk_data,
+                                   file_name=f"OA_reports_{bulk_start}_{bulk_end}.{output}")
+
 elif choice == "AI Detector":
     st.subheader("X-ray AI Detector (Grad-CAM)")
     if st.session_state["user"] is None:
         st.warning("You must be logged in to run detections.")
-    uploaded = st.file_uploader("Upload a Knee X-ray", type=["jpg","jpeg","png"])
+    # Images are saved in the background, so failed writes are reported here on the next rerun
+    for failed_path, error in get_artifact_writer().take_failures():
+        st.error(f"Could not save image {os.path.basename(failed_path)}: {error}")
+    detector_mode = st.radio("Detection mode", ["Single image", "Batch"], horizontal=True)
+    uploaded = None
+    if detector_mode == "Batch":
+        batch_files = st.file_uploader("Upload Knee X-rays (images or .zip folders)", type=["jpg","jpeg","png","zip"], accept_multiple_files=True)
+        batch_size = st.number_input("Max batch size", min_value=1, max_value=64, value=BATCH_MAX_SIZE)
+        if not batch_files:
+            st.session_state.pop("batch_results", None)
+        elif st.button("Run batch analysis"):
+            if MODEL_AVAILABLE and model is not None:
+                progress_text = st.empty()
+                with st.spinner("Analyzing images..."):
+                    try:
+                        st.session_state["batch_results"] = predict_batch(
+                            classifier, iter_uploaded_images(batch_files), max_batch_size=int(batch_size),
+                            progress=lambda n: progress_text.text(f"Processed {n} images"))
+                    except Exception as e:
+                        st.error("Batch analysis failed: " + str(e))
+            else:
+                st.warning("Model not available — cannot run batch prediction.")
+        batch_results = st.session_state.get("batch_results")
+        if batch_results:
+            batch_df, batch_summary = summarize_batch(batch_results)
+            n_failed = int(batch_df["error"].notna().sum()) if "error" in batch_df else 0
+            st.success(f"Analyzed {len(batch_df) - n_failed} images")
+            if n_failed:
+                st.warning(f"{n_failed} file(s) could not be read; see the error column below")
+            st.markdown("### Summary")
+            st.dataframe(batch_summary, use_container_width=True)
+            st.markdown("### Per-image predictions")
+            st.dataframe(batch_df, use_container_width=True)
+            st.download_button("⬇ Download results CSV", batch_df.to_csv(index=False), file_name="batch_predictions.csv")
+    else:
+        uploaded = st.file_uploader("Upload a Knee X-ray", type=["jpg","jpeg","png"])
     if uploaded:
         st.markdown("<div class='glass-card'>", unsafe_allow_html=True)
-        img = Image.open(uploaded).convert("RGB")
-        st.image(img, caption="Uploaded X-ray", width=380)
-        x = transform(img).unsqueeze(0).to(DEVICE)
+        # Decode once at capped resolution; the 224x224 copy feeds both the model input and the
+        # Grad-CAM overlay
+        try:
+            image_digest, rgb = load_upload(uploaded)
+        except UPLOAD_ERRORS as e:
+            st.error(f"Could not read upload: {e}")
+            st.stop()
+        rgb224 = resize_for_model(rgb)
+        st.image(preview_image(rgb), caption="Uploaded X-ray", width=380)
         if MODEL_AVAILABLE and model is not None:
             with st.spinner("Analyzing image..."):
                 try:
-                    heatmap, cls = generate_gradcam(model, x)
+                    cache_key = prediction_cache_key(image_digest)
+                    job_status = st.empty()
+                    probs = classify_image(classifier, rgb224, cache_key,
+                                           poll=lambda status: job_status.caption(f"Inference job {status}..."))
+                    job_status.empty()
+                    cls = int(probs.argmax())
                     grade = CLASSES[cls]
-                    st.success(f"Predicted: {grade}")
-                    img_np = np.array(img.resize((224,224)))
-                    overlay = cv2.addWeighted(img_np, 0.55, heatmap, 0.45, 0)
-                    st.image(overlay, caption="Grad-CAM Overlay", use_column_width=False)
-                    os.makedirs("tmp", exist_ok=True)
+                    st.success(f"Predicted: {grade} ({probs[cls]:.1%} confidence)")
+                    st.dataframe(pd.DataFrame({"Grade": CLASSES, "Probability": probs.round(4)}), use_container_width=False)
                     timestamp_short = datetime.utcnow().strftime("%Y%m%d%H%M%S")
-                    orig_path = f"tmp/orig_{timestamp_short}.jpg"
-                    heat_path = f"tmp/heat_{timestamp_short}.jpg"
-                    img.save(orig_path)
-                    cv2.imwrite(heat_path, overlay)
+                    # Encoded in memory only; written by the background writer when the prediction is saved
+                    orig_artifact = get_artifact_store().encode_image(cv2.cvtColor(rgb, cv2.COLOR_RGB2BGR, dst=rgb))
+                    del rgb
+                    if st.checkbox("Show Grad-CAM explanation", value=False):
+                        overlay = gradcam_overlay(rgb224, explain_image(model, rgb224, cls, cache_key))
+                        st.image(overlay, caption="Grad-CAM Overlay", use_column_width=False)
 
                     st.markdown("### Save prediction?")
                     save_choice = st.radio("Choose how to save this prediction (Option C):",
@@ -2096,7 +3631,9 @@ elif choice == "AI Detector":
                             sel = st.selectbox("Select patient", options=options, format_func=lambda x: x[1])
                             if st.button("Attach prediction to selected patient"):
                                 selected_patient_id = sel[0]
-                                log_inference(selected_patient_id, grade, st.session_state["user"]["id"], orig_path, heat_path, notes="")
+                                heat_artifact = heatmap_artifact(model, rgb224, cls, cache_key)
+                                log_inference(selected_patient_id, grade, st.session_state["user"]["id"], orig_artifact[0], heat_artifact[0],
+                                              notes="", artifacts=[orig_artifact, heat_artifact])
                                 patient = get_patient_by_patient_id(selected_patient_id)
                                 new_notes = (patient.get("notes","") or "") + f"\nInference on {datetime.utcnow().isoformat()}: {grade}"
                                 update_patient(patient["id"], last_visit=datetime.utcnow().strftime("%Y-%m-%d"), notes=new_notes)
@@ -2116,7 +3653,9 @@ elif choice == "AI Detector":
                                 else:
                                     ok, err = create_patient(cp_patient_id.strip(), cp_name.strip(), int(cp_age), cp_gender, cp_last_visit.strftime("%Y-%m-%d"), cp_notes.strip(), st.session_state["user"]["id"])
                                     if ok:
-                                        log_inference(cp_patient_id.strip(), grade, st.session_state["user"]["id"], orig_path, heat_path, notes=cp_notes.strip())
+                                        heat_artifact = heatmap_artifact(model, rgb224, cls, cache_key)
+                                        log_inference(cp_patient_id.strip(), grade, st.session_state["user"]["id"], orig_artifact[0], heat_artifact[0],
+                                                      notes=cp_notes.strip(), artifacts=[orig_artifact, heat_artifact])
                                         st.success(f"Patient {cp_patient_id} created and prediction saved.")
                                     else:
                                         st.error(err)
@@ -2124,16 +3663,20 @@ elif choice == "AI Detector":
                         st.info("Prediction not saved. You can still Download PDF or change choice.")
                         if st.button("Download PDF Report (unsaved)"):
                             patient_info = {"patient_id":"Unassigned", "name":""}
-                            pdf_path = generate_pdf_report(grade, orig_path, heat_path, patient_info=patient_info)
-                            with open(pdf_path, "rb") as f:
-                                st.download_button("⬇ Download Report (Unassigned)", f, file_name="OA_report_unassigned.pdf")
+                            heat_artifact = heatmap_artifact(model, rgb224, cls, cache_key)
+                            persist_artifacts([orig_artifact, heat_artifact])
+                            pdf_bytes = generate_pdf_report(grade, orig_artifact[0], heat_artifact[0], patient_info=patient_info)
+                            st.download_button("⬇ Download Report (Unassigned)", pdf_bytes, file_name="OA_report_unassigned.pdf")
                     if st.button("Download PDF Report (saved/unsaved)"):
                         patient_info = {"patient_id":"", "name":""}
-                        pdf_path = generate_pdf_report(grade, orig_path, heat_path, patient_info=patient_info)
-                        with open(pdf_path, "rb") as f:
-                            st.download_button("⬇ Download Report", f, file_name=f"OA_report_{timestamp_short}.pdf")
+                        heat_artifact = heatmap_artifact(model, rgb224, cls, cache_key)
+                        persist_artifacts([orig_artifact, heat_artifact])
+                        pdf_bytes = generate_pdf_report(grade, orig_artifact[0], heat_artifact[0], patient_info=patient_info)
+                        st.download_button("⬇ Download Report", pdf_bytes, file_name=f"OA_report_{timestamp_short}.pdf")
+                except InferenceQueueFull as e:
+                    st.warning(str(e))
                 except Exception as e:
-                    st.error("Grad-CAM failed: " + str(e))
+                    st.error("Analysis failed: " + str(e))
         else:
             st.warning("Model not available — cannot run prediction. You can still view the image.")
         st.markdown("</div>", unsafe_allow_html=True)
@@ -2255,6 +3798,9 @@ elif choice == "Chat Assistant":
     
     if "selected_xray_for_chat" not in st.session_state:
         st.session_state["selected_xray_for_chat"] = None
+    # True while the last user message in the history still needs an assistant reply
+    if "chat_reply_pending" not in st.session_state:
+        st.session_state["chat_reply_pending"] = False
     
     # X-ray Result Selector
     st.markdown('<div class="xray-selector">', unsafe_allow_html=True)
@@ -2286,15 +3832,7 @@ elif choice == "Chat Assistant":
             grade = selected_log['predicted_grade']
             grade_num = grade.split()[-1] if 'Grade' in grade else '0'
             
-            severity_colors = {
-                '0': ('#10b981', 'Normal - Healthy bone density'),
-                '1': ('#3b82f6', 'Mild Osteopenia - Early bone loss'),
-                '2': ('#f59e0b', 'Moderate Osteopenia - Notable bone loss'),
-                '3': ('#f97316', 'Severe Osteopenia - Significant bone loss'),
-                '4': ('#ef4444', 'Osteoporosis - Critical bone density loss')
-            }
-            
-            color, description = severity_colors.get(grade_num, ('#9ca3af', 'Unknown'))
+            color, description = GRADE_SEVERITY.get(grade_num, ('#9ca3af', 'Unknown'))
             
             st.markdown(f"""
             <div class="xray-info">
@@ -2307,24 +3845,13 @@ elif choice == "Chat Assistant":
             """, unsafe_allow_html=True)
             
             if st.button("🔬 Ask AI to Analyze This Result", key="analyze_btn"):
-                analysis_prompt = f"""I have an X-ray scan result showing {grade}. 
-                
-Patient ID: {selected_log['patient_id']}
-Diagnosis: {grade}
-Severity: {description}
-
-Please provide:
-1. A brief explanation of what this grade means
-2. Potential health implications
-3. Recommended lifestyle changes or treatments
-4. When to seek immediate medical attention
-
-Keep your response professional, clear, and compassionate."""
-
+                # The reply is looked up/cached under the patient-independent prompt for this grade
                 st.session_state["ai_chat_history"].append({
                     "role": "user",
-                    "content": analysis_prompt
+                    "content": grade_analysis_prompt(grade, description, selected_log['patient_id']),
+                    "cache_prompt": grade_analysis_prompt(grade, description)
                 })
+                st.session_state["chat_reply_pending"] = True
                 st.rerun()
     else:
         st.info("No X-ray results available. Run some predictions in the AI Detector first!")
@@ -2353,21 +3880,14 @@ Keep your response professional, clear, and compassionate."""
     
     # Display chat history
     st.markdown('<div class="chat-container">', unsafe_allow_html=True)
+    chat_summary = st.session_state.get("chat_summary")
+    if chat_summary and chat_summary["covered"]:
+        st.caption(f"The first {chat_summary['covered']} messages are sent to the assistant as a summary to stay within the context budget.")
     for msg in st.session_state["ai_chat_history"]:
-        if msg["role"] == "user":
-            st.markdown(f"""
-            <div class="chat-message user-message">
-                <div class="message-header">👤 You</div>
-                <div class="message-content">{msg['content']}</div>
-            </div>
-            """, unsafe_allow_html=True)
-        else:
-            st.markdown(f"""
-            <div class="chat-message bot-message">
-                <div class="message-header">🤖 AI Medical Assistant</div>
-                <div class="message-content">{msg['content']}</div>
-            </div>
-            """, unsafe_allow_html=True)
+        st.markdown(chat_message_html(msg["role"], msg["content"]), unsafe_allow_html=True)
+    # The next message (user input and streamed reply) is rendered here, below the history
+    pending_user_slot = st.empty()
+    reply_slot = st.empty()
     st.markdown('</div>', unsafe_allow_html=True)
     
     # Chat input
@@ -2388,66 +3908,44 @@ Keep your response professional, clear, and compassionate."""
             "role": "user",
             "content": user_input
         })
-        
-        # Call Groq API
-        try:
-            import requests
-            
-            # Prepare messages for API
-            messages = [
-                {
-                    "role": "system",
-                    "content": """You are an expert medical AI assistant specializing in osteoporosis and bone health. 
-                    Provide accurate, compassionate, and professional medical information. 
-                    Always remind users to consult with healthcare professionals for personalized medical advice.
-                    Be clear, concise, and supportive in your responses."""
-                }
-            ]
-            
-            # Add context about selected X-ray if available
-            if st.session_state["selected_xray_for_chat"]:
-                xray_context = st.session_state["selected_xray_for_chat"]
-                messages.append({
-                    "role": "system",
-                    "content": f"Current patient context: X-ray shows {xray_context['predicted_grade']} for patient {xray_context['patient_id']}"
-                })
-            
-            # Add chat history
-            for msg in st.session_state["ai_chat_history"]:
-                messages.append({
-                    "role": msg["role"],
-                    "content": msg["content"]
-                })
-            
-            # API call to Groq
-            response = requests.post(
-                "https://api.groq.com/openai/v1/chat/completions",
-                headers={
-                    "Authorization": f"Bearer {api_key}",
-                    "Content-Type": "application/json"
-                },
-                json={
-                    "model": "llama-3.3-70b-versatile",  # Fast and free model
-                    "messages": messages,
-                    "temperature": 0.7,
-                    "max_tokens": 1024
-                }
-            )
-            
-            if response.status_code == 200:
-                ai_response = response.json()["choices"][0]["message"]["content"]
-                st.session_state["ai_chat_history"].append({
+        st.session_state["chat_reply_pending"] = True
+        pending_user_slot.markdown(chat_message_html("user", user_input), unsafe_allow_html=True)
+
+    # Reply to the last user message (typed, quick question or X-ray analysis). Quick questions and
+    # grade analyses are answered from the shared cache when possible, even without an API key.
+    if st.session_state["chat_reply_pending"]:
+        history = st.session_state["ai_chat_history"]
+        cache_prompt = history[-1].get("cache_prompt") if history else None
+        cached_reply = get_response_cache().get(cache_prompt, GROQ_MODEL, CHAT_TEMPERATURE) if cache_prompt else None
+        if cached_reply is not None:
+            st.session_state["chat_reply_pending"] = False
+            history.append({"role": "assistant", "content": cached_reply})
+            st.rerun()
+        elif api_key and api_key.strip():
+            st.session_state["chat_reply_pending"] = False
+            try:
+                if cache_prompt:
+                    messages = cacheable_chat_messages(cache_prompt)
+                else:
+                    messages = build_chat_messages(api_key.strip(), history, st.session_state["selected_xray_for_chat"])
+                ai_response = stream_chat_reply(api_key.strip(), messages, reply_slot)
+                if cache_prompt:
+                    get_response_cache().put(cache_prompt, GROQ_MODEL, CHAT_TEMPERATURE, ai_response)
+                history.append({
                     "role": "assistant",
                     "content": ai_response
                 })
                 st.rerun()
-            else:
-                error_msg = response.json().get("error", {}).get("message", "Unknown error")
-                st.error(f"API Error: {error_msg}")
-                
-        except Exception as e:
-            st.error(f"Error communicating with AI: {str(e)}")
-            st.info("Please check your API key and internet connection.")
+            except (GatewayBusy, CircuitOpen) as e:
+                reply_slot.empty()
+                st.warning(str(e))
+            except ChatAPIError as e:
+                reply_slot.empty()
+                st.error(f"API Error: {e}")
+            except Exception as e:
+                reply_slot.empty()
+                st.error(f"Error communicating with AI: {str(e)}")
+                st.info("Please check your API key and internet connection.")
     
     elif send_button and not api_key:
         st.warning("Please enter your Groq API key first!")
@@ -2455,27 +3953,28 @@ Keep your response professional, clear, and compassionate."""
     # Clear chat button
     if st.button("🗑️ Clear Chat History"):
         st.session_state["ai_chat_history"] = []
+        st.session_state["chat_summary"] = None
+        st.session_state["chat_reply_pending"] = False
         st.rerun()
     
     # Quick action buttons
     st.markdown("#### ⚡ Quick Questions")
-    quick_questions = [
-        "What are the early signs of osteoporosis?",
-        "What foods help improve bone density?",
-        "What exercises are safe for osteoporosis patients?",
-        "How often should I get bone density scans?",
-        "What are the risk factors for osteoporosis?"
-    ]
-    
-    cols = st.columns(len(quick_questions))
-    for idx, question in enumerate(quick_questions):
+    cols = st.columns(len(CHAT_QUICK_QUESTIONS))
+    for idx, question in enumerate(CHAT_QUICK_QUESTIONS):
         with cols[idx]:
             if st.button(f"💡 {question[:20]}...", key=f"quick_{idx}"):
-                if api_key:
+                # One cache lookup: a hit is answered right here, a miss is left to the reply step
+                cached_reply = get_response_cache().get(question, GROQ_MODEL, CHAT_TEMPERATURE)
+                if cached_reply is not None or api_key:
                     st.session_state["ai_chat_history"].append({
                         "role": "user",
-                        "content": question
+                        "content": question,
+                        "cache_prompt": question
                     })
+                    if cached_reply is not None:
+                        st.session_state["ai_chat_history"].append({"role": "assistant", "content": cached_reply})
+                    else:
+                        st.session_state["chat_reply_pending"] = True
                     st.rerun()
                 else:
                     st.warning("Please enter your Groq API key first!")
@@ -2485,6 +3984,14 @@ elif choice == "Settings":
     st.write("Small preferences")
     st.checkbox("Enable debug logs", value=False)
     st.checkbox("Show advanced model info", value=False)
+    if st.session_state["user"] is not None:
+        st.markdown("### Storage maintenance")
+        st.caption(f"Runs automatically every {STORAGE_CLEANUP_INTERVAL_HOURS:g} hours"
+                   if STORAGE_CLEANUP_INTERVAL_HOURS > 0 else "Scheduled cleanup is disabled")
+        if st.button("Clean up unreferenced images"):
+            with st.spinner("Removing images not attached to any inference log..."):
+                n_removed, n_bytes = clean_up_storage()
+            st.success(f"Removed {n_removed} files ({n_bytes / (1024 * 1024):.1f} MB)")
 
 elif choice == "About":
     st.subheader("About")
@@ -0,0 +1,116 @@
+# export_model.py - Export the ResNet50 checkpoint to an optimized backend and verify it
+#
+#   python export_model.py torchscript
+#   python export_model.py onnx --model models/E6_albumentations.pth --images sample_images
+#   python export_model.py int8 --calibration path/to/xrays --images path/to/eval_xrays
+#   python export_model.py preprocessing --images sample_images   (cv2 pipeline vs the original PIL transform)
+#   (sub-folders "0".."4" or "Grade 0".."Grade 4" provide labels for the per-grade accuracy report)
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+from inference_engine import (
+    BACKENDS, PREPROCESS_PARITY_ATOL, backend_artifact_path, build_model, check_parity,
+    check_preprocessing_parity, export_onnx, export_torchscript,
+    grade_regression_report, load_artifact, load_image_folder, load_labeled_folder, predict_proba,
+    quantize_static, save_quantized, to_model_tensor,
+)
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_MODEL_PATH = os.path.join(SCRIPT_DIR, "models", "E6_albumentations.pth")
+DEFAULT_IMAGES_DIR = os.path.join(SCRIPT_DIR, "sample_images")
+
+def mean_latency_ms(model, x, repeats=10):
+    predict_proba(model, x)  # warm-up
+    start = time.perf_counter()
+    for _ in range(repeats):
+        predict_proba(model, x)
+    return (time.perf_counter() - start) / repeats * 1000
+
+def print_grade_report(rows):
+    print(f"{'Grade':<10}{'Images':>8}{'Agree':>8}{'fp32 acc':>10}{'int8 acc':>10}")
+    fmt = lambda v: "-" if v is None else f"{v:.1%}"
+    for row in rows:
+        print(f"{row['grade']:<10}{row['images']:>8}{fmt(row['agreement']):>8}"
+              f"{fmt(row.get('fp32_accuracy')):>10}{fmt(row.get('int8_accuracy')):>10}")
+
+def quantize(args, eager):
+    names, images, labels = load_labeled_folder(args.calibration)
+    if not images:
+        print(f"No calibration images found in {args.calibration}", file=sys.stderr)
+        return 1
+    quantized, observers = quantize_static(eager, images)
+    out_path = args.out or backend_artifact_path(args.model, "int8")
+    save_quantized(quantized, observers, out_path, names)
+    print(f"Calibrated on {len(images)} images; saved INT8 model to {out_path}")
+
+    _, eval_images, eval_labels = load_labeled_folder(args.images)
+    candidate = load_artifact(out_path, "int8")
+    rows = grade_regression_report(eager, candidate, eval_images, eval_labels)
+    print_grade_report(rows)
+    with open(f"{os.path.splitext(out_path)[0]}.report.json", "w") as f:
+        json.dump(rows, f, indent=2)
+
+    x = to_model_tensor(np.stack(eval_images[:16]))
+    print(f"Mean latency (batch of {len(x)}): fp32 {mean_latency_ms(eager, x):.1f} ms, int8 {mean_latency_ms(candidate, x):.1f} ms")
+    if rows[-1]["agreement"] < args.min_agreement:
+        print(f"INT8 agreement below {args.min_agreement:.0%}", file=sys.stderr)
+        return 1
+    return 0
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Export the OA classifier and check it against eager PyTorch")
+    parser.add_argument("backend", choices=[b for b in BACKENDS if b != "eager"] + ["preprocessing"])
+    parser.add_argument("--model", default=DEFAULT_MODEL_PATH, help="path to the .pth state dict")
+    parser.add_argument("--images", default=DEFAULT_IMAGES_DIR, help="folder of X-rays for the parity check / report")
+    parser.add_argument("--out", default=None, help="artifact path (default: next to the checkpoint, tagged with its version)")
+    parser.add_argument("--atol", type=float, default=None,
+                        help=f"max allowed probability difference (default 1e-3; {PREPROCESS_PARITY_ATOL} for preprocessing)")
+    parser.add_argument("--calibration", default=DEFAULT_IMAGES_DIR, help="int8: folder of calibration X-rays")
+    parser.add_argument("--max-side", type=int, default=int(os.environ.get("OA_MAX_IMAGE_SIDE", "2048")),
+                        help="preprocessing: decode cap used by the app (OA_MAX_IMAGE_SIDE)")
+    parser.add_argument("--max-pixels", type=int, default=int(os.environ.get("OA_MAX_IMAGE_PIXELS", str(150_000_000))),
+                        help="preprocessing: pixel limit used by the app (OA_MAX_IMAGE_PIXELS)")
+    parser.add_argument("--min-agreement", type=float, default=0.95, help="int8: minimum top-1 agreement with fp32")
+    args = parser.parse_args(argv)
+
+    if args.atol is None:
+        args.atol = PREPROCESS_PARITY_ATOL if args.backend == "preprocessing" else 1e-3
+
+    eager = build_model(args.model)
+    if args.backend == "preprocessing":
+        report = check_preprocessing_parity(eager, args.images, max_side=args.max_side,
+                                            max_pixels=args.max_pixels, atol=args.atol)
+        print(f"Preprocessing parity on {report['images']} images: max |dp| = {report['max_abs_diff']:.2e}, "
+              f"top-1 agreement = {report['top1_agreement']:.0%}")
+        if not report["passed"]:
+            print("Preprocessing parity check FAILED", file=sys.stderr)
+            return 1
+        return 0
+    if args.backend == "int8":
+        return quantize(args, eager)
+
+    out_path = args.out or backend_artifact_path(args.model, args.backend)
+    (export_torchscript if args.backend == "torchscript" else export_onnx)(eager, out_path)
+    print(f"Exported {args.backend} artifact to {out_path}")
+
+    candidate = load_artifact(out_path, args.backend)
+    report = check_parity(eager, candidate, args.images, atol=args.atol)
+    print(f"Parity on {report['images']} images: max |dp| = {report['max_abs_diff']:.2e}, "
+          f"top-1 agreement = {report['top1_agreement']:.0%}")
+
+    _, images = load_image_folder(args.images)
+    x = to_model_tensor(np.stack(images))
+    print(f"Mean latency (batch of {len(images)}): eager {mean_latency_ms(eager, x):.1f} ms, "
+          f"{args.backend} {mean_latency_ms(candidate, x):.1f} ms")
+    if not report["passed"]:
+        print("Parity check FAILED", file=sys.stderr)
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,600 @@
+# inference_engine.py - ResNet50 model, preprocessing, Grad-CAM and background inference workers
+# Kept free of Streamlit so it can be imported by worker processes.
+import io
+import os
+import copy
+import json
+import hashlib
+import platform
+import shutil
+import tempfile
+import time
+import uuid
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import numpy as np
+import cv2
+from PIL import Image
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torchvision import models, transforms
+
+DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
+CLASSES = ["Grade 0", "Grade 1", "Grade 2", "Grade 3", "Grade 4"]
+
+INPUT_SIZE = 224
+IMAGENET_MEAN = (0.485, 0.456, 0.406)
+IMAGENET_STD = (0.229, 0.224, 0.225)
+
+# -----------------------
+# Preprocessing: decode once to uint8, resize once, normalize in place
+# -----------------------
+# Bumped whenever preprocessing changes in a way that can shift predictions, so cached results
+# are not reused across versions. 1 = the original PIL/torchvision transform, 2 = the cv2 pipeline.
+PREPROCESS_VERSION = 2
+# Largest class-probability difference accepted between the cv2 pipeline and the reference transform
+PREPROCESS_PARITY_ATOL = 0.02
+# (x / 255 - mean) / std folded into one multiply-add per pixel
+_NORM_SCALE = torch.tensor([1.0 / (255.0 * s) for s in IMAGENET_STD]).view(1, 3, 1, 1)
+_NORM_BIAS = torch.tensor([-m / s for m, s in zip(IMAGENET_MEAN, IMAGENET_STD)]).view(1, 3, 1, 1)
+
+def decode_image(image_bytes):
+    # JPEG/PNG (including 16-bit and grayscale PNGs) -> HxWx3 uint8 RGB array
+    rgb = cv2.imdecode(np.frombuffer(image_bytes, np.uint8), cv2.IMREAD_COLOR)
+    if rgb is None:
+        raise ValueError("Could not decode image")
+    return cv2.cvtColor(rgb, cv2.COLOR_BGR2RGB, dst=rgb)
+
+# cv2 flags that decode a JPEG directly at 1/2, 1/4 or 1/8 scale in the DCT domain
+_REDUCED_DECODE_FLAGS = ((8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4), (2, cv2.IMREAD_REDUCED_COLOR_2))
+
+def decode_image_file(path, max_side=None, max_pixels=None):
+    # Decodes a spooled upload with bounded memory: the header is probed first to reject oversized
+    # images, JPEGs are decoded at reduced resolution when that still covers max_side, and the
+    # result is downscaled so its longest side is at most max_side.
+    with Image.open(path) as probe:
+        width, height = probe.size
+        image_format = probe.format
+    if max_pixels and width * height > max_pixels:
+        raise ValueError(f"Image is {width}x{height} pixels; the limit is {max_pixels:,} pixels")
+    flags = cv2.IMREAD_COLOR
+    if max_side and image_format == "JPEG":
+        for factor, reduced_flags in _REDUCED_DECODE_FLAGS:
+            if max(width, height) // factor >= max_side:
+                flags = reduced_flags
+                break
+    bgr = cv2.imread(path, flags)
+    if bgr is None:
+        raise ValueError("Could not decode image")
+    if max_side and max(bgr.shape[:2]) > max_side:
+        scale = max_side / max(bgr.shape[:2])
+        bgr = cv2.resize(bgr, (max(1, round(bgr.shape[1] * scale)), max(1, round(bgr.shape[0] * scale))),
+                         interpolation=cv2.INTER_AREA)
+    return cv2.cvtColor(bgr, cv2.COLOR_BGR2RGB, dst=bgr)
+
+def resize_for_model(rgb):
+    # The 224x224 uint8 result feeds both the model tensor and the Grad-CAM overlay
+    h, w = rgb.shape[:2]
+    interpolation = cv2.INTER_AREA if h > INPUT_SIZE or w > INPUT_SIZE else cv2.INTER_LINEAR
+    return cv2.resize(rgb, (INPUT_SIZE, INPUT_SIZE), interpolation=interpolation)
+
+def to_model_tensor(rgb224):
+    # (H, W, 3) or (N, H, W, 3) uint8 -> normalized (N, 3, H, W) float32. The NHWC buffer is viewed
+    # as channels_last, so the float conversion is the only copy and normalization happens in place.
+    batch = rgb224[None] if rgb224.ndim == 3 else rgb224
+    x = torch.from_numpy(np.ascontiguousarray(batch)).permute(0, 3, 1, 2).float()
+    return x.mul_(_NORM_SCALE).add_(_NORM_BIAS)
+
+def preprocess_bytes(image_bytes):
+    return resize_for_model(decode_image(image_bytes))
+
+def reference_transform(image_bytes):
+    # The original PIL + torchvision preprocessing, kept only to check the cv2 pipeline against it
+    transform = transforms.Compose([
+        transforms.Resize((INPUT_SIZE, INPUT_SIZE)),
+        transforms.ToTensor(),
+        transforms.Normalize(IMAGENET_MEAN, IMAGENET_STD),
+    ])
+    with Image.open(io.BytesIO(image_bytes)) as image:
+        return transform(image.convert("RGB")).unsqueeze(0)
+
+# -----------------------
+# Model construction
+# -----------------------
+def build_model(model_path, shared_weights=False):
+    # shared_weights memory-maps the checkpoint (copy-on-write) and points the parameters straight at
+    # the mapping, so every process that loads the same file shares one copy in the OS page cache.
+    if shared_weights and DEVICE == "cpu":
+        try:
+            return _build_model_mmap(model_path)
+        except (RuntimeError, ValueError, TypeError):
+            pass  # legacy (non-zipfile) checkpoint or older torch: fall back to a private copy
+    base_model = models.resnet50(pretrained=False)
+    base_model.fc = nn.Linear(base_model.fc.in_features, len(CLASSES))
+    base_model.load_state_dict(torch.load(model_path, map_location=DEVICE))
+    base_model.to(DEVICE).eval()
+    return base_model
+
+def _build_model_mmap(model_path):
+    state_dict = torch.load(model_path, map_location="cpu", mmap=True, weights_only=True)
+    with torch.device("meta"):
+        base_model = models.resnet50(weights=None)
+        base_model.fc = nn.Linear(base_model.fc.in_features, len(CLASSES))
+    base_model.load_state_dict(state_dict, assign=True)
+    return base_model.eval()
+
+# -----------------------
+# Optimized inference backends (TorchScript / ONNX Runtime)
+# -----------------------
+BACKENDS = ("eager", "torchscript", "onnx", "int8")
+
+def checkpoint_version(model_path):
+    # Cheap fingerprint of the checkpoint (mtime + size) so exported artifacts go stale with it
+    st = os.stat(model_path)
+    return hashlib.sha1(f"{st.st_mtime_ns}:{st.st_size}".encode()).hexdigest()[:12]
+
+def backend_artifact_path(model_path, backend):
+    stem = f"{os.path.splitext(model_path)[0]}.{checkpoint_version(model_path)}"
+    return {"torchscript": f"{stem}.torchscript.pt", "onnx": f"{stem}.onnx", "int8": f"{stem}.int8.pt"}[backend]
+
+def _write_atomically(out_path, write, verify=None):
+    # Writes into a private temp directory next to out_path, load-checks the result and renames it
+    # into place, so concurrent exporters never leave (or load) a half-written or unloadable
+    # artifact. Any sidecar files the writer produces are removed with the directory.
+    tmp_dir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(out_path)), prefix=".export-")
+    tmp = os.path.join(tmp_dir, os.path.basename(out_path))
+    try:
+        write(tmp)
+        if verify is not None:
+            verify(tmp)
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, out_path)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return out_path
+
+def verify_artifact(path, backend):
+    # Raises if the exported file cannot be loaded back (TorchScript) or is not a valid,
+    # self-contained ONNX model
+    if backend == "onnx":
+        import onnx
+        onnx.checker.check_model(path)
+    else:
+        torch.jit.load(path, map_location="cpu")
+
+def export_torchscript(model, out_path):
+    # Trace and freeze; optimize_for_inference() output cannot be reloaded once saved, so the
+    # conv+bn folding and fusion are applied after loading instead (see load_artifact)
+    example = torch.zeros(1, 3, INPUT_SIZE, INPUT_SIZE, device=DEVICE)
+    with torch.no_grad():
+        frozen = torch.jit.freeze(torch.jit.trace(model.eval(), example))
+    return _write_atomically(out_path, frozen.save, verify=lambda tmp: verify_artifact(tmp, "torchscript"))
+
+def export_onnx(model, out_path, opset=17):
+    # The weights must live inside the .onnx file: the exporter may write them to an external
+    # "<name>.data" sidecar, so the graph is re-saved as one self-contained file
+    import onnx
+    example = torch.zeros(1, 3, INPUT_SIZE, INPUT_SIZE, device=DEVICE)
+    def write(tmp):
+        raw = tmp + ".raw"
+        torch.onnx.export(
+            model.eval(), example, raw,
+            input_names=["input"], output_names=["logits"],
+            dynamic_axes={"input": {0: "batch"}, "logits": {0: "batch"}},
+            opset_version=opset, dynamo=False,
+        )
+        onnx.save_model(onnx.load(raw), tmp, save_as_external_data=False)
+    return _write_atomically(out_path, write, verify=lambda tmp: verify_artifact(tmp, "onnx"))
+
+class OnnxModel:
+    # Minimal nn.Module-like wrapper so predict_proba() can call an ONNX Runtime session
+    def __init__(self, onnx_path, num_threads=None):
+        try:
+            import onnxruntime as ort
+        except ImportError as e:
+            raise RuntimeError("The onnx backend requires the onnxruntime package") from e
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.intra_op_num_threads = num_threads or torch.get_num_threads()
+        self.session = ort.InferenceSession(onnx_path, options, providers=["CPUExecutionProvider"])
+        self.input_name = self.session.get_inputs()[0].name
+
+    def eval(self):
+        return self
+
+    def __call__(self, x):
+        inputs = np.ascontiguousarray(x.detach().cpu().numpy(), dtype=np.float32)
+        logits = self.session.run(None, {self.input_name: inputs})[0]
+        return torch.from_numpy(logits)
+
+def load_backend(model_path, backend="eager", eager_model=None, shared_weights=False):
+    # Returns a callable classifier for the backend, exporting the artifact from the checkpoint if
+    # missing. Artifact names carry the checkpoint version, so a retrained checkpoint is re-exported.
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown model backend: {backend}")
+    if backend == "eager":
+        return eager_model if eager_model is not None else build_model(model_path, shared_weights)
+    artifact = backend_artifact_path(model_path, backend)
+    if backend == "int8" and not os.path.exists(artifact):
+        raise RuntimeError(f"No INT8 model for this checkpoint at {artifact}; calibrate one with `python export_model.py int8 --calibration <folder>`")
+    if backend != "int8" and os.path.exists(artifact):
+        try:
+            verify_artifact(artifact, backend)
+        except ImportError:
+            raise
+        except Exception:
+            # Unloadable artifact (e.g. written by an older exporter): rebuild it below
+            os.remove(artifact)
+    if not os.path.exists(artifact):
+        source = eager_model if eager_model is not None else build_model(model_path, shared_weights)
+        (export_torchscript if backend == "torchscript" else export_onnx)(source, artifact)
+    return load_artifact(artifact, backend)
+
+def load_artifact(artifact, backend):
+    if backend == "int8":
+        if DEVICE != "cpu":
+            raise RuntimeError("The int8 backend only runs on CPU")
+        torch.backends.quantized.engine = quantized_engine()
+        return torch.jit.load(artifact, map_location="cpu").eval()
+    if backend == "torchscript":
+        return torch.jit.optimize_for_inference(torch.jit.load(artifact, map_location=DEVICE).eval())
+    return OnnxModel(artifact)
+
+def load_image_folder(images_dir, extensions=(".jpg", ".jpeg", ".png")):
+    # Returns file names and their preprocessed 224x224 uint8 RGB arrays
+    names = sorted(n for n in os.listdir(images_dir) if n.lower().endswith(extensions))
+    images = []
+    for n in names:
+        with open(os.path.join(images_dir, n), "rb") as f:
+            images.append(preprocess_bytes(f.read()))
+    return names, images
+
+def load_labeled_folder(images_dir, extensions=(".jpg", ".jpeg", ".png")):
+    # Sub-folders named "0".."4" or "Grade 0".."Grade 4" provide ground-truth labels;
+    # a flat folder is returned unlabeled (labels = None).
+    label_dirs = {}
+    for entry in sorted(os.listdir(images_dir)):
+        path = os.path.join(images_dir, entry)
+        label = entry[len("Grade "):] if entry.startswith("Grade ") else entry
+        if os.path.isdir(path) and label.isdigit() and int(label) < len(CLASSES):
+            label_dirs[path] = int(label)
+    if not label_dirs:
+        names, images = load_image_folder(images_dir, extensions)
+        return names, images, None
+    names, images, labels = [], [], []
+    for path, label in label_dirs.items():
+        sub_names, sub_images = load_image_folder(path, extensions)
+        names += [os.path.join(os.path.basename(path), n) for n in sub_names]
+        images += sub_images
+        labels += [label] * len(sub_images)
+    return names, images, np.array(labels)
+
+def predict_images(model, images, batch_size=16):
+    return np.concatenate([
+        predict_proba(model, to_model_tensor(np.stack(images[start:start + batch_size])))
+        for start in range(0, len(images), batch_size)
+    ])
+
+# -----------------------
+# INT8 post-training static quantization
+# -----------------------
+def quantized_engine():
+    return "qnnpack" if platform.machine().lower() in ("arm64", "aarch64") else "fbgemm"
+
+def quantize_static(model, calibration_images, batch_size=16):
+    # FX graph mode PTQ: insert observers, calibrate on real X-rays, convert to INT8 kernels.
+    # Returns (quantized model, observer state_dict) - the latter is the saved calibration artifact.
+    from torch.ao.quantization import get_default_qconfig_mapping
+    from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+    engine = quantized_engine()
+    torch.backends.quantized.engine = engine
+    float_model = copy.deepcopy(model).cpu().eval()
+    example = (torch.zeros(1, 3, INPUT_SIZE, INPUT_SIZE),)
+    prepared = prepare_fx(float_model, get_default_qconfig_mapping(engine), example)
+    with torch.no_grad():
+        for start in range(0, len(calibration_images), batch_size):
+            prepared(to_model_tensor(np.stack(calibration_images[start:start + batch_size])))
+    observers = {k: v for k, v in prepared.state_dict().items() if "activation_post_process" in k}
+    return convert_fx(prepared), observers
+
+def save_quantized(quantized_model, observers, artifact, calibration_names):
+    with torch.no_grad():
+        traced = torch.jit.trace(quantized_model, torch.zeros(1, 3, INPUT_SIZE, INPUT_SIZE))
+    _write_atomically(artifact, lambda tmp: torch.jit.save(traced, tmp))
+    stem = os.path.splitext(artifact)[0]
+    torch.save(observers, f"{stem}.observers.pt")
+    with open(f"{stem}.calibration.json", "w") as f:
+        json.dump({"engine": quantized_engine(), "images": len(calibration_names),
+                   "calibration_files": calibration_names}, f, indent=2)
+    return artifact
+
+def grade_regression_report(reference_model, candidate_model, images, labels=None):
+    # Per-grade comparison of the candidate (e.g. INT8) against the fp32 reference. With labels the
+    # rows carry accuracy for both models; without, agreement with the reference's predictions.
+    ref_pred = predict_images(reference_model, images).argmax(axis=1)
+    cand_pred = predict_images(candidate_model, images).argmax(axis=1)
+    truth = labels if labels is not None else ref_pred
+    rows = []
+    for grade, name in enumerate(CLASSES):
+        mask = truth == grade
+        n = int(mask.sum())
+        row = {"grade": name, "images": n,
+               "agreement": float((ref_pred[mask] == cand_pred[mask]).mean()) if n else None}
+        if labels is not None:
+            row["fp32_accuracy"] = float((ref_pred[mask] == grade).mean()) if n else None
+            row["int8_accuracy"] = float((cand_pred[mask] == grade).mean()) if n else None
+        rows.append(row)
+    overall = {"grade": "All", "images": len(images), "agreement": float((ref_pred == cand_pred).mean())}
+    if labels is not None:
+        overall["fp32_accuracy"] = float((ref_pred == labels).mean())
+        overall["int8_accuracy"] = float((cand_pred == labels).mean())
+    return rows + [overall]
+
+def check_parity(reference_model, candidate_model, images_dir, atol=1e-3):
+    # Compares class probabilities of a backend against the eager model on a folder of X-rays
+    names, images = load_image_folder(images_dir)
+    if not images:
+        raise ValueError(f"No images found in {images_dir}")
+    x = to_model_tensor(np.stack(images))
+    ref = predict_proba(reference_model, x)
+    cand = predict_proba(candidate_model, x)
+    max_abs_diff = float(np.abs(ref - cand).max())
+    agreement = float((ref.argmax(axis=1) == cand.argmax(axis=1)).mean())
+    return {
+        "images": len(names),
+        "max_abs_diff": max_abs_diff,
+        "top1_agreement": agreement,
+        "passed": max_abs_diff <= atol and agreement == 1.0,
+    }
+
+def check_preprocessing_parity(model, images_dir, max_side=2048, max_pixels=None, atol=PREPROCESS_PARITY_ATOL,
+                               extensions=(".jpg", ".jpeg", ".png")):
+    # Compares predictions on the production upload path (decode_image_file with the app's
+    # max_side, i.e. reduced-DCT JPEG decoding and the capped downscale, then resize_for_model)
+    # against reference_transform() on a folder of X-rays. Resampling differs (INTER_AREA vs PIL's
+    # antialiased bilinear), so inputs are not bit-identical; the check requires identical top-1
+    # grades and probabilities within atol.
+    names = sorted(n for n in os.listdir(images_dir) if n.lower().endswith(extensions))
+    if not names:
+        raise ValueError(f"No images found in {images_dir}")
+    current, reference = [], []
+    for n in names:
+        path = os.path.join(images_dir, n)
+        current.append(resize_for_model(decode_image_file(path, max_side=max_side, max_pixels=max_pixels)))
+        with open(path, "rb") as f:
+            reference.append(reference_transform(f.read()))
+    cur = predict_proba(model, to_model_tensor(np.stack(current)))
+    ref = predict_proba(model, torch.cat(reference))
+    max_abs_diff = float(np.abs(ref - cur).max())
+    agreement = float((ref.argmax(axis=1) == cur.argmax(axis=1)).mean())
+    return {
+        "images": len(names),
+        "max_abs_diff": max_abs_diff,
+        "top1_agreement": agreement,
+        "passed": max_abs_diff <= atol and agreement == 1.0,
+    }
+
+# -----------------------
+# Fast classification (no gradients)
+# -----------------------
+def predict_proba(model, x_tensor):
+    # Forward pass only: returns an (N, len(CLASSES)) numpy array of class probabilities
+    model.eval()
+    with torch.inference_mode():
+        return torch.softmax(model(x_tensor.to(DEVICE)), dim=1).cpu().numpy()
+
+# -----------------------
+# Grad-CAM
+# -----------------------
+# RGB lookup table for COLORMAP_JET so colormapping can be applied to a whole batch with one index op
+JET_LUT = cv2.cvtColor(cv2.applyColorMap(np.arange(256, dtype=np.uint8).reshape(256, 1), cv2.COLORMAP_JET),
+                       cv2.COLOR_BGR2RGB).reshape(256, 3)
+
+def get_cam_layer(model):
+    # ResNet50: target the last conv block in layer4
+    return model.layer4[-1]
+
+def colorize_cams(cams, size=224):
+    # cams: (N, K, h, w) tensor -> (N, K, size, size, 3) uint8 RGB heatmaps
+    cams = F.interpolate(cams, size=(size, size), mode="bilinear", align_corners=False)
+    cams = cams / cams.amax(dim=(2, 3), keepdim=True).clamp_min(1e-12)
+    return JET_LUT[(cams * 255).to(torch.uint8).cpu().numpy()]
+
+def generate_gradcam_batch(model, x_batch, target_classes=None, top_k=1):
+    # One forward pass for the whole batch; one backward per requested class rank, all reusing
+    # the same captured activations. Returns (heatmaps (N, K, 224, 224, 3), classes (N, K), probs (N, C)).
+    model.eval()
+    # The hook lives only for this call and writes to a local list (from this thread only), so
+    # concurrent callers sharing one model never see each other's activations
+    captured, caller = [], threading.get_ident()
+    def capture(module, input, output):
+        if threading.get_ident() == caller:
+            captured.append(output)
+    handle = get_cam_layer(model).register_forward_hook(capture)
+    with torch.enable_grad():
+        try:
+            out = model(x_batch.to(DEVICE))
+        finally:
+            handle.remove()
+        if not captured or not captured[-1].requires_grad:
+            raise RuntimeError("Grad-CAM could not capture a differentiable activation from the target layer")
+        feat = captured[-1]
+        if target_classes is None:
+            classes = out.topk(top_k, dim=1).indices
+        else:
+            classes = torch.as_tensor(target_classes, device=out.device).reshape(out.shape[0], -1)
+        probs = torch.softmax(out.detach(), dim=1).cpu().numpy()
+        cams = []
+        for k in range(classes.shape[1]):
+            # Samples are independent in eval mode, so the summed score yields per-sample gradients
+            score = out.gather(1, classes[:, k:k + 1]).sum()
+            grads, = torch.autograd.grad(score, feat, retain_graph=k < classes.shape[1] - 1)
+            pooled_grads = grads.mean(dim=(2, 3), keepdim=True)
+            cams.append(torch.relu((feat * pooled_grads).sum(dim=1)))
+    cams = torch.stack(cams, dim=1).detach()
+    return colorize_cams(cams), classes.cpu().numpy(), probs
+
+def generate_gradcam(model, x_tensor, target_class=None):
+    targets = None if target_class is None else [target_class]
+    heatmaps, classes, _ = generate_gradcam_batch(model, x_tensor, target_classes=targets)
+    return heatmaps[0, 0], int(classes[0, 0])
+
+# -----------------------
+# Background inference workers
+# -----------------------
+class InferenceQueueFull(RuntimeError):
+    pass
+
+# Per-process models. The classifier is loaded by the pool initializer; the fp32 eager model that
+# Grad-CAM needs is only loaded on the first explain job, so INT8 workers stay small.
+_worker_model_path = None
+_worker_shared_weights = False
+_worker_model = None
+_worker_classifier = None
+
+def _init_worker(model_path, num_threads, backend="eager", shared_weights=False):
+    global _worker_model_path, _worker_shared_weights, _worker_model, _worker_classifier
+    torch.set_num_threads(num_threads)
+    _worker_model_path = model_path
+    _worker_shared_weights = shared_weights
+    _worker_classifier = load_backend(model_path, backend, shared_weights=shared_weights)
+    if backend == "eager":
+        _worker_model = _worker_classifier
+
+def _worker_eager_model():
+    global _worker_model
+    if _worker_model is None:
+        _worker_model = build_model(_worker_model_path, _worker_shared_weights)
+    return _worker_model
+
+def _run_job(kind, rgb224, target_class=None):
+    # Jobs carry the 224x224 uint8 image (~150 KB) rather than the raw upload
+    x = to_model_tensor(rgb224)
+    if kind == "predict":
+        return predict_proba(_worker_classifier, x)[0]
+    if kind == "explain":
+        heatmap, _ = generate_gradcam(_worker_eager_model(), x, target_class=target_class)
+        return heatmap
+    raise ValueError(f"Unknown inference job kind: {kind}")
+
+class InferenceService:
+    # Process pool where every worker loads the model once and runs with its own share of the CPU
+    # cores, so concurrent sessions queue for a worker instead of oversubscribing torch threads.
+    # At most max_pending jobs may be queued or running; further submits raise InferenceQueueFull.
+    def __init__(self, model_path, workers=2, max_pending=16, threads_per_worker=None, backend="eager",
+                 shared_weights=False, result_ttl=600):
+        threads = threads_per_worker or max(1, (os.cpu_count() or 1) // workers)
+        self.max_pending = max_pending
+        self.result_ttl = result_ttl
+        self._workers = workers
+        self._initargs = (model_path, threads, backend, shared_weights)
+        self._executor = self._new_executor()
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._jobs = {}
+        self._finished = {}
+        self._lock = threading.Lock()
+
+    def _new_executor(self):
+        return ProcessPoolExecutor(
+            max_workers=self._workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=self._initargs,
+        )
+
+    def _restart(self, broken):
+        # A worker that dies (e.g. OOM-killed) breaks the whole pool; replace it once, however many
+        # callers notice at the same time. Jobs on the broken pool fail and release their slots.
+        with self._lock:
+            if self._executor is broken:
+                self._executor = self._new_executor()
+                broken.shutdown(wait=False, cancel_futures=True)
+
+    def submit(self, kind, rgb224, target_class=None):
+        if not self._slots.acquire(blocking=False):
+            raise InferenceQueueFull("Inference queue is full, please retry in a few seconds")
+        try:
+            try:
+                executor = self._executor
+                future = executor.submit(_run_job, kind, rgb224, target_class)
+            except BrokenProcessPool:
+                self._restart(executor)
+                executor = self._executor
+                future = executor.submit(_run_job, kind, rgb224, target_class)
+        except Exception:
+            self._slots.release()
+            raise
+        job_id = uuid.uuid4().hex
+        with self._lock:
+            self._prune()
+            self._jobs[job_id] = (future, executor)
+        future.add_done_callback(lambda _: self._job_finished(job_id))
+        return job_id
+
+    def _job_finished(self, job_id):
+        self._slots.release()
+        with self._lock:
+            self._finished[job_id] = time.monotonic()
+
+    def _prune(self):
+        # Drop finished jobs whose results were never collected (e.g. closed sessions) once they
+        # are older than result_ttl; uncollected recent results stay available to their session
+        cutoff = time.monotonic() - self.result_ttl
+        for job_id in [j for j, finished in self._finished.items() if finished < cutoff]:
+            self._jobs.pop(job_id, None)
+            del self._finished[job_id]
+
+    def status(self, job_id):
+        with self._lock:
+            future, _ = self._jobs.get(job_id, (None, None))
+        if future is None:
+            return "unknown"
+        if future.cancelled():
+            return "cancelled"
+        if future.done():
+            return "failed" if future.exception() is not None else "done"
+        return "running" if future.running() else "queued"
+
+    def result(self, job_id, timeout=None):
+        with self._lock:
+            future, executor = self._jobs[job_id]
+        try:
+            return future.result(timeout=timeout)
+        except BrokenProcessPool:
+            self._restart(executor)
+            raise
+        finally:
+            if future.done():
+                with self._lock:
+                    self._jobs.pop(job_id, None)
+                    self._finished.pop(job_id, None)
+
+    def run(self, kind, rgb224, target_class=None, timeout=None, poll=None):
+        # Submit and wait, reporting status changes through poll(status)
+        job_id = self.submit(kind, rgb224, target_class)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        last_status, retried = None, False
+        while True:
+            status = self.status(job_id)
+            if poll and status != last_status:
+                poll(status)
+                last_status = status
+            if status in ("done", "failed", "cancelled"):
+                try:
+                    return self.result(job_id)
+                except BrokenProcessPool:
+                    # The worker died mid-job and result() replaced the pool: give the job one more try
+                    if retried:
+                        raise
+                    retried = True
+                    job_id, last_status = self.submit(kind, rgb224, target_class), None
+                    continue
+            if deadline is not None and time.monotonic() > deadline:
+                raise TimeoutError(f"Inference job {job_id} did not finish within {timeout}s")
+            time.sleep(0.05)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,382 @@
+# llm_client.py - OpenAI-compatible chat completions client (Groq) with pooled connections and SSE streaming
+# Kept free of Streamlit; point base_url at a local mock server to exercise it without the real API.
+import json
+import time
+import random
+import hashlib
+import threading
+from collections import OrderedDict, deque
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+DEFAULT_BASE_URL = "https://api.groq.com/openai/v1"
+DEFAULT_MODEL = "llama-3.3-70b-versatile"
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+class ChatAPIError(Exception):
+    def __init__(self, message, status_code=None, retry_after=None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+    @property
+    def retryable(self):
+        # Connection failures (no status), rate limiting and server errors
+        return self.status_code is None or self.status_code in RETRY_STATUSES
+
+class GatewayBusy(ChatAPIError):
+    pass
+
+class CircuitOpen(ChatAPIError):
+    pass
+
+def _retry_after(response):
+    try:
+        return float(response.headers.get("Retry-After", ""))
+    except ValueError:
+        return None
+
+def _error_message(response):
+    try:
+        return response.json().get("error", {}).get("message") or response.reason
+    except ValueError:
+        return response.text[:200] or response.reason
+
+class ChatClient:
+    # One keep-alive requests.Session per process. Connection errors, 429 and 5xx responses are
+    # retried with exponential backoff (honouring Retry-After) before any response body is read,
+    # so a retry never duplicates streamed output.
+    def __init__(self, base_url=DEFAULT_BASE_URL, connect_timeout=5.0, read_timeout=60.0, retries=2,
+                 backoff=0.5, pool_size=10):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = (connect_timeout, read_timeout)
+        retry = Retry(total=retries, connect=retries, read=0, status=retries, backoff_factor=backoff,
+                      status_forcelist=RETRY_STATUSES, allowed_methods=frozenset({"POST"}),
+                      respect_retry_after_header=True, raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def _post(self, api_key, payload, stream):
+        try:
+            response = self.session.post(
+                f"{self.base_url}/chat/completions",
+                headers={"Authorization": f"Bearer {api_key}", "Content-Type": "application/json"},
+                json=payload, stream=stream, timeout=self.timeout)
+        except requests.RequestException as e:
+            raise ChatAPIError(f"Could not reach the chat API: {e}") from e
+        if response.status_code != 200:
+            message = _error_message(response)
+            response.close()
+            raise ChatAPIError(message, response.status_code, _retry_after(response))
+        return response
+
+    def complete(self, api_key, messages, model=DEFAULT_MODEL, temperature=0.7, max_tokens=1024):
+        payload = {"model": model, "messages": messages, "temperature": temperature, "max_tokens": max_tokens}
+        with self._post(api_key, payload, stream=False) as response:
+            return response.json()["choices"][0]["message"]["content"]
+
+    def stream(self, api_key, messages, model=DEFAULT_MODEL, temperature=0.7, max_tokens=1024):
+        # Yields content deltas as the server sends them (text/event-stream "data: {...}" lines)
+        payload = {"model": model, "messages": messages, "temperature": temperature, "max_tokens": max_tokens,
+                   "stream": True}
+        with self._post(api_key, payload, stream=True) as response:
+            response.encoding = response.encoding or "utf-8"
+            try:
+                for line in response.iter_lines(decode_unicode=True):
+                    if not line or not line.startswith("data:"):
+                        continue
+                    data = line[len("data:"):].strip()
+                    if data == "[DONE]":
+                        return
+                    chunk = json.loads(data)
+                    if "error" in chunk:
+                        raise ChatAPIError(chunk["error"].get("message", "Streaming error"))
+                    choices = chunk.get("choices") or [{}]
+                    delta = (choices[0].get("delta") or {}).get("content")
+                    if delta:
+                        yield delta
+            except requests.RequestException as e:
+                raise ChatAPIError(f"Chat stream interrupted: {e}") from e
+
+    def close(self):
+        self.session.close()
+
+# -----------------------
+# Token-budgeted conversation context
+# -----------------------
+# Rough token estimate (~4 characters per token for English text, plus per-message framing).
+# No tokenizer for the served model is available here, so budgets leave some headroom.
+CHARS_PER_TOKEN = 4
+MESSAGE_OVERHEAD_TOKENS = 4
+
+SUMMARY_INSTRUCTIONS = ("You compress medical consultations. Merge the previous summary and the new turns into one "
+                        "summary of at most {words} words. Keep patient IDs, grades, symptoms, advice already given "
+                        "and open questions. Reply with the summary only.")
+
+def estimate_tokens(text):
+    return len(text) // CHARS_PER_TOKEN + 1
+
+def message_tokens(messages):
+    return sum(estimate_tokens(m["content"]) + MESSAGE_OVERHEAD_TOKENS for m in messages)
+
+def dedupe_turns(messages):
+    # Drops earlier copies of a repeated user message (e.g. the same "Analyze this result" prompt)
+    # together with the reply that followed them; the latest copy is kept in place.
+    last_seen = {m["content"]: i for i, m in enumerate(messages) if m["role"] == "user"}
+    kept, skip_reply = [], False
+    for i, m in enumerate(messages):
+        if m["role"] == "user":
+            skip_reply = last_seen[m["content"]] != i
+            if skip_reply:
+                continue
+        elif skip_reply:
+            skip_reply = False
+            continue
+        kept.append(m)
+    return kept
+
+class ChatContextWindow:
+    # Builds the messages for one request within max_tokens (minus the tokens reserved for the reply):
+    # the system prompt, the X-ray context once, a running summary of older turns, then the most
+    # recent turns that fit. When turns have to be evicted, the window is cut to half its budget so
+    # the summary is refreshed every few turns rather than on every request.
+    def __init__(self, system_prompt, max_tokens=6000, reply_tokens=1024, summary_words=150):
+        self.system_prompt = system_prompt
+        self.max_tokens = max_tokens
+        self.reply_tokens = reply_tokens
+        self.summary_words = summary_words
+
+    def _window_start(self, turns, budget):
+        # Earliest index such that turns[index:] fits the budget, starting on a user message;
+        # the final turn is always kept even if it alone exceeds the budget
+        used, start = 0, len(turns)
+        for i in range(len(turns) - 1, -1, -1):
+            used += message_tokens([turns[i]])
+            if used > budget and i < len(turns) - 1:
+                break
+            start = i
+        while 0 < start < len(turns) - 1 and turns[start]["role"] != "user":
+            start += 1
+        return start
+
+    def _fallback_summary(self, previous, turns):
+        lines = [previous] if previous else []
+        lines += [f"User asked: {m['content'][:200]}" for m in turns if m["role"] == "user"]
+        return "\n".join(lines)[-self.summary_words * 8:]
+
+    def build(self, history, summary=None, xray_context=None, summarize=None):
+        # summary is {"text", "covered"}: a summary of history[:covered]. Returns (messages, summary).
+        # summarize(previous_text, evicted_turns, max_words) produces the new summary text.
+        summary = dict(summary or {"text": "", "covered": 0})
+        if summary["covered"] > len(history):
+            summary = {"text": "", "covered": 0}
+        fixed = [{"role": "system", "content": self.system_prompt}]
+        if xray_context:
+            fixed.append({"role": "system", "content": xray_context})
+        turns = dedupe_turns(history[summary["covered"]:])
+        # ~1.3 tokens per English word; the summary allowance is doubled for headroom
+        budget = self.max_tokens - self.reply_tokens - message_tokens(fixed) - self.summary_words * 2
+        start = self._window_start(turns, budget)
+        if start > 0:
+            start = self._window_start(turns, budget // 2)
+            evicted = turns[:start]
+            text = None
+            if summarize is not None:
+                try:
+                    text = summarize(summary["text"], evicted, self.summary_words)
+                except ChatAPIError:
+                    text = None
+            summary = {"text": text or self._fallback_summary(summary["text"], evicted),
+                       "covered": summary["covered"] + self._covered_count(history[summary["covered"]:], turns[start])}
+            turns = turns[start:]
+        messages = list(fixed)
+        if summary["text"]:
+            messages.append({"role": "system", "content": "Summary of the earlier conversation: " + summary["text"]})
+        return messages + turns, summary
+
+    def _covered_count(self, raw_turns, first_kept):
+        # Number of raw history messages before first_kept (dedupe may have removed some of them)
+        for i, m in enumerate(raw_turns):
+            if m is first_kept:
+                return i
+        return len(raw_turns)
+
+# -----------------------
+# Outbound gateway: rate limits, fair queuing, retries, circuit breaker
+# -----------------------
+class TokenBucket:
+    def __init__(self, rate_per_second, capacity):
+        self.rate = rate_per_second
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, deadline):
+        # Takes one token, sleeping until one is available; returns False if that would pass deadline
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return True
+                wait = (1 - self.tokens) / self.rate
+            if now + wait > deadline:
+                return False
+            time.sleep(wait)
+
+class CircuitBreaker:
+    # Opens after `threshold` consecutive failures and rejects calls for `cooldown` seconds; then a
+    # single trial call is let through (half-open) and its outcome closes or re-opens the circuit
+    def __init__(self, threshold=5, cooldown=30.0):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+        self._lock = threading.Lock()
+
+    def before_call(self):
+        with self._lock:
+            if self.opened_at is None:
+                return
+            remaining = self.opened_at + self.cooldown - time.monotonic()
+            if remaining > 0 or self.trial_running:
+                raise CircuitOpen(f"Chat API unavailable after repeated failures; retrying in {int(max(remaining, 0)) + 1}s")
+            self.trial_running = True
+
+    def record(self, success):
+        with self._lock:
+            self.trial_running = False
+            if success:
+                self.failures, self.opened_at = 0, None
+                return
+            self.failures += 1
+            if self.failures >= self.threshold or self.opened_at is not None:
+                self.opened_at = time.monotonic()
+
+class LLMGateway:
+    # Single in-process entry point for chat API calls. Requests wait in per-session FIFO queues
+    # that are served round-robin, so one busy session cannot starve the others; at most
+    # max_in_flight calls run at once and each API key is held to its own token bucket.
+    # Connection errors, 429 and 5xx are retried with full-jitter exponential backoff (or the
+    # server's Retry-After) until the circuit breaker trips on a sustained outage.
+    def __init__(self, client, max_in_flight=4, rate_per_minute=30, burst=10, retries=3, backoff=0.5,
+                 max_backoff=8.0, queue_timeout=60.0, breaker_threshold=5, breaker_cooldown=30.0):
+        self.client = client
+        self.max_in_flight = max_in_flight
+        self.rate_per_minute = rate_per_minute
+        self.burst = burst
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.queue_timeout = queue_timeout
+        self.breaker = CircuitBreaker(breaker_threshold, breaker_cooldown)
+        self._cond = threading.Condition()
+        self._queues = OrderedDict()
+        self._in_flight = 0
+        self._buckets = {}
+
+    def _bucket(self, api_key):
+        key = hashlib.sha256(api_key.encode()).hexdigest()
+        with self._cond:
+            if key not in self._buckets:
+                self._buckets[key] = TokenBucket(self.rate_per_minute / 60.0, self.burst)
+            return self._buckets[key]
+
+    def _is_next(self, ticket):
+        return self._in_flight < self.max_in_flight and next(iter(self._queues.values()))[0] is ticket
+
+    def _acquire_slot(self, session_id, deadline):
+        ticket = object()
+        with self._cond:
+            self._queues.setdefault(session_id, deque()).append(ticket)
+            while not self._is_next(ticket):
+                remaining = deadline - time.monotonic()
+                if remaining > 0:
+                    self._cond.wait(remaining)
+                    continue
+                self._queues[session_id].remove(ticket)
+                if not self._queues[session_id]:
+                    del self._queues[session_id]
+                self._cond.notify_all()
+                raise GatewayBusy("The assistant is busy, please retry in a moment")
+            queue_ = self._queues.pop(session_id)
+            queue_.popleft()
+            if queue_:
+                # Re-queue the session behind every other waiting session (round-robin)
+                self._queues[session_id] = queue_
+            self._in_flight += 1
+            self._cond.notify_all()
+
+    def _release_slot(self):
+        with self._cond:
+            self._in_flight -= 1
+            self._cond.notify_all()
+
+    def _backoff_delay(self, attempt, error):
+        if error.retry_after is not None:
+            return min(error.retry_after, self.max_backoff)
+        return random.uniform(0, min(self.max_backoff, self.backoff * (2 ** attempt)))
+
+    def _should_retry(self, error, attempt, deadline):
+        if not error.retryable or attempt >= self.retries:
+            return False
+        delay = self._backoff_delay(attempt, error)
+        if time.monotonic() + delay > deadline:
+            return False
+        time.sleep(delay)
+        return True
+
+    def _call(self, api_key, deadline, attempt_fn):
+        # Runs attempt_fn under the key's rate limit and the circuit breaker, retrying transient errors.
+        # Every attempt that passed before_call() records exactly one outcome, whatever it raises,
+        # so a failed half-open trial can never leave the circuit stuck open.
+        bucket = self._bucket(api_key)
+        for attempt in range(self.retries + 1):
+            if not bucket.acquire(deadline):
+                raise GatewayBusy("Chat API rate limit reached, please retry in a moment", 429)
+            self.breaker.before_call()
+            try:
+                result = attempt_fn()
+            except ChatAPIError as e:
+                # Rate limiting and client errors mean the API is reachable; only connection and
+                # server errors count towards the circuit breaker
+                self.breaker.record(not e.retryable or e.status_code == 429)
+                if self._should_retry(e, attempt, deadline):
+                    continue
+                raise
+            except BaseException:
+                self.breaker.record(False)
+                raise
+            self.breaker.record(True)
+            return result
+
+    def complete(self, session_id, api_key, messages, **kwargs):
+        deadline = time.monotonic() + self.queue_timeout
+        self._acquire_slot(session_id, deadline)
+        try:
+            return self._call(api_key, deadline, lambda: self.client.complete(api_key, messages, **kwargs))
+        finally:
+            self._release_slot()
+
+    def stream(self, session_id, api_key, messages, **kwargs):
+        # Retries only happen before the first delta, so streamed output is never duplicated
+        def start():
+            deltas = self.client.stream(api_key, messages, **kwargs)
+            return deltas, next(deltas, None)
+
+        deadline = time.monotonic() + self.queue_timeout
+        self._acquire_slot(session_id, deadline)
+        try:
+            deltas, first = self._call(api_key, deadline, start)
+            if first is not None:
+                yield first
+                yield from deltas
+        finally:
+            self._release_slot()